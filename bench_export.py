@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+export.py on a synthetic answers file (1M rows by default) against loading the whole file the way
+ad-hoc scripts do: csv rows in a list, then results.AnswerStats and the comments per judge.
+Every variant runs in its own process, peak memory is the largest resident set of that process
+and the processes it started.
+Run:
+python bench_export.py --rows 1000000 --processes 1,2,4
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import export
+import results
+from form_config import PLACE, RATE4, FormVersions
+
+JUDGES = 300
+ROUNDS = 8
+TEAMS = 400
+SURNAMES = ["Ivanov", "Петрова", "O'Neil", "Kask"]
+COMMENT_WORDS = ["судья", "опоздал", "объяснил", "решение", "подробно", "грубо", "спасибо", "аргументы",
+                 "оппозиция", "правительство", "кратко", "понятно", "фидбек", "модель", "время"]
+
+
+def write_answers(filename: str, rows: int, form_filename: str, comment_share: float) -> None:
+    versions = FormVersions(form_filename)
+    versions.reload()
+    config = versions.current
+    places = config.stages[PLACE].choices
+    compliance = config.stages[RATE4].choices
+    judges = [f"Judge {i} {random.choice(SURNAMES)}" for i in range(JUDGES)]
+    with open(filename, "w", newline='', encoding="utf-8") as file:
+        writer = csv.writer(file, lineterminator="\n")
+        writer.writerow(results.HEADER)
+        for i in range(rows):
+            comment = ""
+            if random.random() < comment_share:
+                comment = " ".join(random.choices(COMMENT_WORDS, k=random.randint(3, 30)))
+                # Some comments have several lines and quotes
+                if random.random() < 0.1:
+                    comment = f'"{comment}",\n{comment}'
+            writer.writerow([f"2026-{i % 12 + 1:02d}-01 12:00:00", str(1000 + i % 50000), f"user{i % 50000}",
+                             f"User {i % 50000}", str(random.randint(1, ROUNDS)), random.choice(judges),
+                             f"Team {random.randrange(TEAMS)}", random.choice(places), str(random.randint(1, 5)),
+                             str(random.randint(1, 5)), str(random.randint(1, 5)), random.choice(compliance),
+                             comment, "ДА"])
+
+
+def peak_memory_mb() -> float:
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / 1024  # kilobytes on Linux
+
+
+# The whole file in memory, one pass over the rows
+def load_all(filename: str, win_value: str, compliant_value: str) -> int:
+    with open(filename, newline='', encoding="utf-8") as file:
+        rows = [row for row in csv.reader(file) if len(row) >= len(results.HEADER)][1:]
+    stats = results.AnswerStats(win_value, compliant_value)
+    comments: Dict[str, List[str]] = {}
+    for row in rows:
+        stats.add(row)
+        if row[results.FEEDBACK_COL]:
+            comments.setdefault(row[results.JUDGE_COL], []).append(row[results.FEEDBACK_COL])
+    return len(rows)
+
+
+def run_variant(name: str, processes: int, args: argparse.Namespace, values: tuple,
+                output: multiprocessing.Queue) -> None:
+    out = tempfile.mkdtemp(dir=args.directory)
+    started = time.perf_counter()
+    if name == "load all":
+        rows = load_all(args.filename, *values)
+    else:
+        rows, _ = export.export_results(args.filename, out, *values, processes=processes,
+                                        chunk_size=int(args.chunk_mb * 2 ** 20), progress=False)
+    output.put({"variant": name, "processes": processes, "rows": rows, "seconds": time.perf_counter() - started,
+                "peak_mb": peak_memory_mb()})
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--processes", default="1,2,4", help="comma separated pool sizes for export.py")
+    parser.add_argument("--chunk-mb", type=float, default=export.CHUNK_SIZE / 2 ** 20)
+    parser.add_argument("--comment-share", type=float, default=0.3)
+    parser.add_argument("--form", default="form.json")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    versions = FormVersions(args.form)
+    versions.reload()
+    values = (versions.current.stages[PLACE].choices[0], versions.current.stages[RATE4].choices[0])
+    print(f"{os.cpu_count()} CPUs")
+
+    with tempfile.TemporaryDirectory() as directory:
+        args.directory = directory
+        args.filename = os.path.join(directory, "answers_out.csv")
+        started = time.perf_counter()
+        write_answers(args.filename, args.rows, args.form, args.comment_share)
+        print(f"{args.rows} rows, {os.path.getsize(args.filename) / 2 ** 20:.0f} MB written in "
+              f"{time.perf_counter() - started:.1f} s")
+
+        context = multiprocessing.get_context("spawn")
+        variants = [("load all", 1)] + [("export", int(count)) for count in args.processes.split(",")]
+        rows = []
+        for name, processes in variants:
+            output = context.Queue()
+            process = context.Process(target=run_variant, args=(name, processes, args, values, output))
+            process.start()
+            rows.append(output.get())
+            process.join()
+            if rows[-1]["rows"] != args.rows:
+                sys.exit(f"{name}: {rows[-1]['rows']} rows counted instead of {args.rows}")
+
+    print(f"{'variant':>9} {'processes':>9} {'seconds':>8} {'rows/s':>9} {'peak MB':>8}")
+    for row in rows:
+        print(f"{row['variant']:>9} {row['processes']:>9} {row['seconds']:>8.2f} "
+              f"{row['rows'] / row['seconds']:>9.0f} {row['peak_mb']:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+Load test of the form flow without network: USERS simulated debaters send /start at (almost) the same time
+and click through ROUND -> ... -> CONFIRMATION with random think times.
+The real handlers from bot.setup_callbacks run on top of fake_bot_api.FakeRequest.
+Prints throughput and p50/p95/p99 handler latency per stage and writes everything into a json file.
+Run:
+python bench_load.py --users 200 --output bench_load.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import pickle
+import platform
+import random
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from telegram import Update
+
+import bot
+from fake_bot_api import FakeRequest
+
+_ids = itertools.count(1)
+
+EDIT_TIMEOUT: float = 30.0
+
+
+def user_dict(user_id: int) -> Dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"user{user_id}"}
+
+
+def message_update(user_id: int, text: str) -> Dict:
+    message = {"message_id": next(_ids), "date": int(time.time()), "text": text, "from": user_dict(user_id),
+               "chat": {"id": user_id, "type": "private", "username": f"user{user_id}"}}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_ids), "message": message}
+
+
+def callback_update(user_id: int, data: str, message_id: int) -> Dict:
+    message = {"message_id": message_id, "date": int(time.time()), "text": "",
+               "chat": {"id": user_id, "type": "private"}}
+    return {"update_id": next(_ids), "callback_query": {"id": str(next(_ids)), "from": user_dict(user_id),
+                                                        "chat_instance": str(user_id), "data": data,
+                                                        "message": message}}
+
+
+def percentile(values: List[float], share: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))] if values else 0.0
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.fake = FakeRequest()
+        self.application = bot.build_application(lambda: self.fake)
+        self.latencies: Dict[str, List[float]] = {}
+        self.updates = 0
+        self.peak_user_data = 0
+        self.peak_callback_data = 0
+
+    async def process(self, stage: str, data: Dict) -> None:
+        update = Update.de_json(data, self.application.bot)
+        started = time.perf_counter()
+        await self.application.process_update(update)
+        self.latencies.setdefault(stage, []).append(time.perf_counter() - started)
+        self.updates += 1
+
+    async def think(self) -> None:
+        await asyncio.sleep(random.uniform(self.args.think_min, self.args.think_max))
+
+    async def user(self, user_id: int) -> None:
+        await asyncio.sleep(random.uniform(0, self.args.spread))
+        await self.process("start", message_update(user_id, "/start"))
+        while True:
+            markup = self.fake.last_markup.get(user_id)
+            if not markup or not markup.get("inline_keyboard"):
+                return
+            buttons = [row[0] for row in markup["inline_keyboard"]]
+            stage = int(buttons[0]["callback_data"][:2])
+            await self.think()
+            if stage == bot.FEEDBACK and random.random() < self.args.comment_share:
+                await self.process("FEEDBACK text", message_update(user_id, "Всё было хорошо, спасибо"))
+                await self.wait_for_edit(user_id, markup)
+                continue
+            # Almost everybody confirms
+            button = buttons[0] if stage == bot.CONFIRMATION else random.choice(buttons)
+            data = callback_update(user_id, button["callback_data"], self.fake.last_message_id[user_id])
+            await self.process(bot.STAGE_NAMES[stage], data)
+            await self.wait_for_edit(user_id, markup)
+
+    # Edits are sent in the background, a real user sees the next question only after the edit arrives
+    async def wait_for_edit(self, user_id: int, markup: Dict) -> None:
+        deadline = time.perf_counter() + EDIT_TIMEOUT
+        while self.fake.last_markup.get(user_id) is markup and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+
+    def memory(self) -> Dict[str, int]:
+        cache = getattr(self.application.bot, "callback_data_cache", None)
+        return {
+            "live_forms": sum(1 for data in self.application.user_data.values() if "form" in data),
+            "user_data_bytes": len(pickle.dumps(dict(self.application.user_data))),
+            "callback_data_bytes": len(pickle.dumps(cache.persistence_data)) if cache is not None else 0,
+        }
+
+    async def sample_memory(self) -> None:
+        while True:
+            memory = self.memory()
+            self.peak_user_data = max(self.peak_user_data, memory["user_data_bytes"])
+            self.peak_callback_data = max(self.peak_callback_data, memory["callback_data_bytes"])
+            await asyncio.sleep(0.5)
+
+    async def run(self) -> Dict:
+        await self.application.initialize()
+        await self.application.start()
+        sampler = asyncio.create_task(self.sample_memory())
+        started = time.perf_counter()
+        await asyncio.gather(*(self.user(user_id) for user_id in range(1, self.args.users + 1)))
+        duration = time.perf_counter() - started
+        sampler.cancel()
+        memory = self.memory()
+        await self.application.stop()
+        await self.application.shutdown()
+        for tenant in bot.tenants.values():
+            tenant.close()
+
+        handler_time = sum(sum(values) for values in self.latencies.values())
+        return {
+            "python": platform.python_version(),
+            "users": self.args.users,
+            "duration_s": duration,
+            "updates": self.updates,
+            "throughput_updates_per_s": self.updates / duration,
+            "handler_capacity_updates_per_s": self.updates / handler_time if handler_time else 0.0,
+            "answers_saved": sum(tenant.answer_sink.flushed_rows for tenant in bot.tenants.values()),
+            "stages": {
+                stage: {"count": len(values), "p50_ms": percentile(values, 0.50) * 1000,
+                        "p95_ms": percentile(values, 0.95) * 1000, "p99_ms": percentile(values, 0.99) * 1000,
+                        "max_ms": max(values) * 1000}
+                for stage, values in self.latencies.items()
+            },
+            "memory": {"peak_user_data_bytes": self.peak_user_data,
+                       "peak_callback_data_bytes": self.peak_callback_data, "end": memory},
+            "api_calls": self.fake.calls,
+            "edits_coalesced": bot.outbound_scheduler.coalesced,
+        }
+
+
+def print_result(result: Dict) -> None:
+    print(f"{result['users']} users, {result['updates']} updates in {result['duration_s']:.1f} s, "
+          f"{result['throughput_updates_per_s']:.0f} updates/s "
+          f"(handlers alone: {result['handler_capacity_updates_per_s']:.0f} updates/s)")
+    print(f"{'stage':>14} {'count':>6} {'p50, ms':>8} {'p95, ms':>8} {'p99, ms':>8} {'max, ms':>8}")
+    for stage, values in result["stages"].items():
+        print(f"{stage:>14} {values['count']:>6} {values['p50_ms']:>8.2f} {values['p95_ms']:>8.2f} "
+              f"{values['p99_ms']:>8.2f} {values['max_ms']:>8.2f}")
+    print(f"Memory: {result['memory']}")
+    print(f"API calls: {result['api_calls']}, edits coalesced: {result['edits_coalesced']}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--spread", type=float, default=1.0, help="seconds over which the /start commands arrive")
+    parser.add_argument("--think-min", type=float, default=0.2, help="seconds")
+    parser.add_argument("--think-max", type=float, default=1.5, help="seconds")
+    parser.add_argument("--comment-share", type=float, default=0.3, help="share of users writing a comment")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-metrics", action="store_true", help="turn off timing, to measure its overhead")
+    parser.add_argument("--global-rate", type=float, default=bot.outbound_global_rate,
+                        help="Bot API requests per second allowed by the rate limiter")
+    parser.add_argument("--chat-rate", type=float, default=bot.outbound_chat_rate,
+                        help="Bot API requests per second into one chat allowed by the rate limiter")
+    parser.add_argument("--output", default="bench_load.json")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    bot.metrics_enabled = not args.no_metrics
+    bot.outbound_global_rate = args.global_rate
+    bot.outbound_chat_rate = args.chat_rate
+    output = os.path.abspath(args.output)
+    errors = bot.reload_forms()
+    if errors:
+        sys.exit("; ".join(errors))
+
+    # All files the bot writes end up in a temporary directory
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        for tenant in bot.tenants.values():
+            tenant.start()
+        result = asyncio.run(LoadTest(args).run())
+        os.chdir(os.path.dirname(output))
+
+    result["argv"] = sys.argv[1:]
+    print_result(result)
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(result, file, indent=2, ensure_ascii=False)
+    print(f"Written to {output}")
+
+
+if __name__ == "__main__":
+    main()
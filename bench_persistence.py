@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Compares PicklePersistence and SqlitePersistence at 1k/10k/100k users, every one in the middle of a form
+stored the way the bot stores it:
+startup  - creating the persistence and loading what the Application loads at startup
+           (the sqlite persistence loads the users with an unfinished form, see bot.preload_user_data)
+flush    - one persistence run after DIRTY_USERS users changed their forms
+Run:
+python bench_persistence.py
+"""
+import asyncio
+import os
+import tempfile
+import time
+from typing import Dict
+
+from telegram.ext import PicklePersistence
+
+import bot
+from form_config import JUDGE, PLACE, RATE1, ROUND, TEAM, FormConfig, FormVersions
+from sqlite_persistence import SqlitePersistence
+
+SIZES = (1000, 10000, 100000)
+DIRTY_USERS = 50
+
+
+def load_config(filename: str = bot.form_filename) -> FormConfig:
+    versions = FormVersions(filename)
+    versions.reload()
+    return versions.current
+
+
+# user_data of a user who picked a tournament and, with `form`, is halfway through a form of `config`
+def user_data(user_id: int, config: FormConfig, form: bool = True) -> Dict:
+    data: Dict = {"tenant": ""}
+    if form:
+        answers = {ROUND: "2", JUDGE: "Vladislav Konstantinov", TEAM: "Гиппопотомомонстросесквиппедалиофобия",
+                   PLACE: config.stages[PLACE].choices[0]}
+        data["form"] = bot.new_form(RATE1, config.version, "")
+        data["form"].update(answers=answers, summary=bot.answers_to_str(answers, config), message_id=user_id,
+                            touched=time.time())
+    return data
+
+
+async def bench_pickle(directory: str, users: int, config: FormConfig) -> Dict[str, float]:
+    filepath = os.path.join(directory, f"bench_{users}.pickle")
+    persistence = PicklePersistence(filepath, on_flush=True)
+    for user_id in range(users):
+        await persistence.update_user_data(user_id, user_data(user_id, config))
+    await persistence.flush()
+
+    started = time.perf_counter()
+    persistence = PicklePersistence(filepath, on_flush=True)
+    await persistence.get_user_data()
+    startup = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for user_id in range(DIRTY_USERS):
+        await persistence.update_user_data(user_id, user_data(user_id, config))
+    await persistence.flush()
+    flush = time.perf_counter() - started
+    return {"startup": startup, "flush": flush, "size": os.path.getsize(filepath)}
+
+
+async def bench_sqlite(directory: str, users: int, config: FormConfig) -> Dict[str, float]:
+    filepath = os.path.join(directory, f"bench_{users}.sqlite")
+    persistence = SqlitePersistence(filepath)
+    for user_id in range(users):
+        await persistence.update_user_data(user_id, user_data(user_id, config))
+    await persistence.flush()
+
+    started = time.perf_counter()
+    persistence = SqlitePersistence(filepath, preload_user_data=bot.preload_user_data)
+    await persistence.get_user_data()
+    await persistence.get_bot_data()
+    await persistence.get_callback_data()
+    startup = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for user_id in range(DIRTY_USERS):
+        await persistence.refresh_user_data(user_id, {})
+        await persistence.update_user_data(user_id, user_data(user_id, config))
+    persistence.commit()
+    flush = time.perf_counter() - started
+    await persistence.flush()
+    return {"startup": startup, "flush": flush, "size": os.path.getsize(filepath)}
+
+
+async def main() -> None:
+    config = load_config()
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'users':>8} {'backend':>8} {'startup, ms':>12} {'flush, ms':>10} {'size, KB':>10}")
+        for users in SIZES:
+            for name, bench in (("pickle", bench_pickle), ("sqlite", bench_sqlite)):
+                result = await bench(directory, users, config)
+                print(f"{users:>8} {name:>8} {result['startup'] * 1000:>12.1f} {result['flush'] * 1000:>10.1f} "
+                      f"{result['size'] / 1024:>10.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the message rendered after every button press, for a whole form from ROUND to CONFIRMATION.
+"rebuilt" walks all answers and creates the keyboard on every press (how the bot used to do it),
+"cached" is bot.get_text_and_reply_markup with the prebuilt keyboards and the incrementally extended summary.
+Run:
+python bench_render.py --forms 2000
+"""
+import argparse
+import random
+import sys
+import time
+from typing import Callable, Dict, List
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import bot
+from form_config import FormConfig, encode_callback_data
+
+
+def render_rebuilt(stage: int, form: Dict, config: FormConfig) -> (str, InlineKeyboardMarkup):
+    result = ""
+    for answer, value in form["answers"].items():
+        if answer == bot.CONFIRMATION or (answer == bot.FEEDBACK and value == config.no_feedback):
+            continue
+        result += f"{config.stages[answer].summary} {value}\n"
+    buttons: List[InlineKeyboardButton] = []
+    for index, option in enumerate(config.stages[stage].choices):
+        buttons.append(InlineKeyboardButton(option, callback_data=encode_callback_data(stage, index, config.version)))
+    return f"Твой выбор:\n{result}\n{config.stages[stage].question}", InlineKeyboardMarkup.from_column(buttons)
+
+
+def press_rebuilt(form: Dict, stage: int, value: str, config: FormConfig) -> None:
+    form["answers"][stage] = value
+    if stage != bot.CONFIRMATION:
+        render_rebuilt(stage + 1, form, config)
+
+
+def press_cached(form: Dict, stage: int, value: str, config: FormConfig) -> None:
+    bot.set_answer(form, stage, value)
+    if stage != bot.CONFIRMATION:
+        bot.get_text_and_reply_markup(stage + 1, form)
+
+
+# Returns seconds per press for every stage
+def measure(press: Callable, config: FormConfig, forms: int) -> Dict[int, float]:
+    totals: Dict[int, float] = {}
+    for _ in range(forms):
+        form = bot.new_form(config.first_stage, config.version, "")
+        for stage in range(config.first_stage, bot.CONFIRMATION + 1):
+            value = random.choice(config.stages[stage].choices)
+            started = time.perf_counter()
+            press(form, stage, value, config)
+            totals[stage] = totals.get(stage, 0.0) + time.perf_counter() - started
+    return {stage: total / forms for stage, total in totals.items()}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--forms", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    errors = bot.reload_forms()
+    if errors:
+        sys.exit("; ".join(errors))
+    config = bot.tenants[""].form_versions.current
+
+    results = {}
+    for name, press in (("rebuilt", press_rebuilt), ("cached", press_cached)):
+        random.seed(args.seed)
+        measure(press, config, args.forms // 10 or 1)  # warm up
+        results[name] = measure(press, config, args.forms)
+
+    print(f"{args.forms} forms, microseconds per press")
+    print(f"{'stage':>14} {'rebuilt':>9} {'cached':>9} {'speedup':>8}")
+    for stage in results["rebuilt"]:
+        rebuilt, cached = results["rebuilt"][stage] * 1e6, results["cached"][stage] * 1e6
+        print(f"{bot.STAGE_NAMES[stage]:>14} {rebuilt:>9.2f} {cached:>9.2f} {rebuilt / cached:>7.1f}x")
+    rebuilt, cached = sum(results["rebuilt"].values()) * 1e6, sum(results["cached"].values()) * 1e6
+    print(f"{'whole form':>14} {rebuilt:>9.2f} {cached:>9.2f} {rebuilt / cached:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
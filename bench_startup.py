@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+Startup of the bot with a long history: ANSWERS saved answers, CHATS known chats and USERS users in the persistence,
+every --live-form-every-th of them in the middle of a form.
+"blocking" reads all saved answers before taking updates (how the bot used to start),
+"background" is the current startup, the answers are read while updates are already handled.
+Every run is a new process, so imports are counted as well (nothing of the bot is imported at the top of this file).
+Telegram is replaced by fake_bot_api.FakeRequest.
+ready          - the process started until the application takes updates
+first /start   - the process started until the reply to a /start sent right then was sent
+answers loaded - the process started until all saved answers were read
+Run:
+python bench_startup.py --answers 300000
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Dict
+
+
+async def write_persistence(filename: str, users: int, form_filename: str, live_form_every: int) -> None:
+    import bench_persistence
+    from sqlite_persistence import SqlitePersistence
+    config = bench_persistence.load_config(form_filename)
+    persistence = SqlitePersistence(filename)
+    for user_id in range(users):
+        await persistence.update_user_data(user_id, bench_persistence.user_data(user_id, config,
+                                                                                user_id % live_form_every == 0))
+    await persistence.flush()
+
+
+def write_chat_ids(filename: str, chats: int) -> None:
+    now = int(time.time())
+    with open(filename, "w", encoding="utf-8") as file:
+        for chat_id in range(chats):
+            file.write(f"{chat_id},{now},{now},user{chat_id}\n")
+
+
+def run(mode: str, directory: str, output: multiprocessing.Queue) -> None:
+    started = time.perf_counter()
+    import bot
+    from bench_load import message_update
+    from fake_bot_api import FakeRequest
+    from telegram import Update
+
+    os.chdir(directory)
+    bot.startup = bot.StartupTimer(started)
+    bot.startup.step("imports")
+    bot.load_chat_registries()
+    bot.startup.step("chat ids")
+    errors = bot.reload_forms()
+    if errors:
+        sys.exit("; ".join(errors))
+    bot.startup.step("forms")
+    bot.start_services()
+    if mode == "blocking":
+        for tenant in bot.tenants.values():
+            tenant.loaded.wait()
+    bot.startup.step("services")
+    fake = FakeRequest()
+    application = bot.build_application(lambda: fake)
+    bot.startup.step("application")
+
+    async def serve() -> Dict:
+        await application.initialize()
+        await bot.post_init(application)
+        await application.start()
+        ready = time.perf_counter() - started
+        await application.process_update(Update.de_json(message_update(10 ** 9, "/start"), application.bot))
+        first_start = time.perf_counter() - started
+        for tenant in bot.tenants.values():
+            await tenant.wait_loaded()
+        loaded = time.perf_counter() - started
+        await application.stop()
+        await application.shutdown()
+        return {"mode": mode, "ready": ready, "first_start": first_start, "loaded": loaded,
+                "steps": bot.startup.to_str()}
+
+    output.put(asyncio.run(serve()))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--answers", type=int, default=300000)
+    parser.add_argument("--chats", type=int, default=50000)
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--live-form-every", type=int, default=10,
+                        help="every n-th user has an unfinished form, keep users / n below bot.max_live_forms")
+    parser.add_argument("--comment-share", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    import bench_export
+    import bot
+    form_filename = os.path.abspath(bot.form_filename)
+
+    with tempfile.TemporaryDirectory() as directory:
+        with open(form_filename, "rb") as source, open(os.path.join(directory, bot.form_filename), "wb") as target:
+            target.write(source.read())
+        bench_export.write_answers(os.path.join(directory, bot.output_filename), args.answers, form_filename,
+                                   args.comment_share)
+        write_chat_ids(os.path.join(directory, bot.chat_ids_filename), args.chats)
+        asyncio.run(write_persistence(os.path.join(directory, bot.persistence_filename), args.users, form_filename,
+                                      args.live_form_every))
+        print(f"{args.answers} answers, {args.chats} chats, {args.users} users in the persistence, "
+              f"{len(range(0, args.users, args.live_form_every))} with an unfinished form")
+
+        context = multiprocessing.get_context("spawn")
+        rows = []
+        for mode in ("blocking", "background"):
+            output = context.Queue()
+            process = context.Process(target=run, args=(mode, directory, output))
+            process.start()
+            rows.append(output.get())
+            process.join()
+
+    print(f"{'':>10} {'ready, s':>9} {'first /start, s':>16} {'answers loaded, s':>18}")
+    for row in rows:
+        print(f"{row['mode']:>10} {row['ready']:>9.2f} {row['first_start']:>16.2f} {row['loaded']:>18.2f}")
+    for row in rows:
+        print(f"{row['mode']}: {row['steps']}")
+
+
+if __name__ == "__main__":
+    main()
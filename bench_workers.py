@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Throughput of the multi-process mode (workers.py) with 1, 2, ... N worker processes.
+USERS simulated debaters fill in the whole form, the updates are handed to the workers the same way
+the ingress does it (by chat id). Every worker talks over HTTP to its own fake_bot_api.FakeBotApiServer
+process, so the stand-in for Telegram is not the bottleneck. Rate limits are turned off.
+Message ids are counted per chat by the fake server, so the button presses can be made up in advance.
+At the end answers_out.csv is checked: one complete line per user, nothing interleaved.
+Run:
+python bench_workers.py --workers 1,2,4 --users 2000
+"""
+import argparse
+import csv
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import bot
+import results
+import workers
+from bench_load import callback_update, message_update
+from fake_bot_api import FakeBotApiServer
+from form_config import encode_callback_data
+
+
+def run_fake_api(ports: multiprocessing.Queue, latency: float) -> None:
+    server = FakeBotApiServer("127.0.0.1", 0, latency)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+# All updates of one user filling in the form, the /start reply is message 1 of the chat
+def user_updates(user_id: int, comment_share: float) -> List[Dict]:
+    config = bot.tenants[""].form_versions.current
+    updates = [message_update(user_id, "/start")]
+    message_id = 1
+    for stage in range(config.first_stage, bot.CONFIRMATION + 1):
+        if stage == bot.FEEDBACK and random.random() < comment_share:
+            updates.append(message_update(user_id, "Всё было хорошо, спасибо"))
+            # The confirmation comes as a new message
+            message_id += 1
+            continue
+        index = 0 if stage in (bot.FEEDBACK, bot.CONFIRMATION) else random.randrange(len(config.stages[stage].choices))
+        updates.append(callback_update(user_id, encode_callback_data(stage, index, config.version), message_id))
+    return updates
+
+
+def check_answers(filename: str, users: int) -> str:
+    chat_ids = set()
+    broken = 0
+    with open(filename, newline='', encoding="utf-8") as file:
+        for row in csv.reader(file):
+            if row == results.HEADER:
+                continue
+            if len(row) != len(results.HEADER):
+                broken += 1
+                continue
+            chat_ids.add(row[results.CHAT_ID_COL])
+    return "ok" if broken == 0 and len(chat_ids) == users else f"{len(chat_ids)} answers, {broken} broken lines"
+
+
+def run(count: int, args: argparse.Namespace) -> Dict:
+    context = multiprocessing.get_context("spawn")
+    ports = context.Queue()
+    servers = [context.Process(target=run_fake_api, args=(ports, args.latency), daemon=True) for _ in range(count)]
+    for server in servers:
+        server.start()
+    queues = [context.Queue() for _ in range(count)]
+    done = context.Queue()
+    ready = [context.Event() for _ in range(count)]
+    processes = []
+    for index in range(count):
+        settings = {"bot_api_base_url": f"http://127.0.0.1:{ports.get()}/bot",
+                    "outbound_global_rate": 1e9, "outbound_chat_rate": 1e9, "outbound_chat_burst": 1e9}
+        processes.append(context.Process(target=workers.worker_main,
+                                         args=(index, count, queues[index], done, settings, ready[index])))
+    for process in processes:
+        process.start()
+    for event in ready:
+        event.wait()
+
+    random.seed(args.seed)
+    per_user = [user_updates(user_id, args.comment_share) for user_id in range(1, args.users + 1)]
+    total = sum(len(updates) for updates in per_user)
+    started = time.time()
+    # Everybody sends /start, then everybody picks the round, and so on
+    for step in range(max(len(updates) for updates in per_user)):
+        for user_id, updates in enumerate(per_user, start=1):
+            if step < len(updates):
+                queues[workers.shard(user_id, count)].put(updates[step])
+    for updates in queues:
+        updates.put(None)
+    finished = max(done.get()[2] for _ in range(count))
+    for process in processes:
+        process.join()
+    for server in servers:
+        server.terminate()
+    duration = finished - started
+    return {"workers": count, "updates": total, "duration_s": duration, "updates_per_s": total / duration,
+            "answers": check_answers(bot.tenants[""].output_filename, args.users)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4", help="comma separated numbers of worker processes")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the fake Bot API takes per request")
+    parser.add_argument("--comment-share", type=float, default=0.3, help="share of users writing a comment")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    errors = bot.reload_forms()
+    if errors:
+        sys.exit("; ".join(errors))
+    form_filename = os.path.abspath(bot.tenants[""].form_filename)
+    print(f"{os.cpu_count()} CPUs")
+
+    rows = []
+    for count in (int(value) for value in args.workers.split(",")):
+        # Every run starts with empty files
+        with tempfile.TemporaryDirectory() as directory:
+            shutil.copy(form_filename, directory)
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                rows.append(run(count, args))
+            finally:
+                os.chdir(cwd)
+
+    print(f"{'workers':>7} {'updates':>8} {'seconds':>8} {'updates/s':>10} {'speedup':>8}  answers")
+    for row in rows:
+        print(f"{row['workers']:>7} {row['updates']:>8} {row['duration_s']:>8.2f} {row['updates_per_s']:>10.0f} "
+              f"{row['updates_per_s'] / rows[0]['updates_per_s']:>7.2f}x  {row['answers']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,21 +3,54 @@
 """
 Install:
 pip install python-telegram-bot --upgrade
-pip install python-telegram-bot[callback-data]
+pip install python-telegram-bot[job-queue]  # removes abandoned forms in the background
+pip install python-telegram-bot[webhooks]  # only for --mode webhook
+Run:
+python bot.py                                                       # polling
+python bot.py --mode webhook --webhook-url https://example.org/telegram  # webhook
 """
+import time
+
+# Startup time is counted from here, see StartupTimer
+startup_started = time.perf_counter()
+
+import argparse
 import asyncio
+import contextlib
+import csv
+import os
+import queue
+import re
+import threading
+from collections import OrderedDict
 from datetime import datetime
 
 import logging
-from typing import List, Tuple, Dict, cast
+from typing import Callable, Iterator, List, Tuple, Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows, only one process writes the files there
+    fcntl = None
 
 import telegram
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, Chat
-from telegram.ext import (Application, CallbackQueryHandler, CommandHandler, ContextTypes, InvalidCallbackData,
-                          PicklePersistence, MessageHandler, filters, ApplicationBuilder)
+from telegram.ext import (Application, BaseUpdateProcessor, CallbackQueryHandler, CommandHandler, ContextTypes,
+                          MessageHandler, filters)
+from telegram.request import BaseRequest, HTTPXRequest
+
+import metrics
+import results
+import search
+from form_config import (ROUND, JUDGE, TEAM, PLACE, RATE1, RATE2, RATE3, RATE4, FEEDBACK, CONFIRMATION, STAGE_NAMES,
+                         CALLBACK_PATTERN, FormConfig, FormVersions)
+from rate_limit import OutboundScheduler
+from sqlite_persistence import SqlitePersistence, migrate_pickle
 
 # Enable logging
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+# Every Bot API request would be logged otherwise
+logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 ###############################################################
@@ -26,165 +59,769 @@ logger = logging.getLogger(__name__)
 # If this string is empty no message will be sent and bot will start in normal mode
 # Otherwise, the message will be sent to all users and BOT WILL NOT BE STARTED
 message_to_all_users: str = ''
+# Only send the message to chats that used /start during the last N days, 0 means everyone
+message_seen_within_days: int = 0
+# Number of messages in flight at once while broadcasting
+broadcast_concurrency: int = 16
 
 output_filename = 'answers_out.csv'
 chat_ids_filename = 'chat_ids.txt'
+persistence_filename = 'debate_test_bot.sqlite'
+# Old persistence file, copied into persistence_filename once if that does not exist yet
+pickle_persistence_filename = 'debate_test_bot.picklepersistence'
+
+# Answers are written by a background thread in batches
+# Rows queued within this many seconds are written together
+answers_flush_interval: float = 0.5
+# fsync after every batch, otherwise the OS decides when the data hits the disk
+answers_fsync: bool = True
+# A chat answering again for the same round, judge and team:
+# "latest" - the new answer replaces the old one, "reject" - the new answer is not saved.
+# Replaced answers stay in the file until `python bot.py --compact` is run while the bot is stopped
+duplicate_answers: str = "latest"
 
 TOKEN_STR: str = "TOKEN"
+# How updates are received, "polling" or "webhook", can be overridden with --mode
+run_mode: str = "polling"
+# Local HTTP server for the webhook mode, TLS is expected to be done by a reverse proxy
+webhook_listen: str = "127.0.0.1"
+webhook_port: int = 8443
+webhook_path: str = "telegram"
+# Public URL Telegram sends the updates to, e.g. "https://example.org/telegram", required in webhook mode
+webhook_url: str = ""
+# Telegram sends it in every webhook request, requests without it are rejected
+webhook_secret_token: str = ""
+# Updates processed at the same time, updates of one chat are always processed one after another
+max_concurrent_updates: int = 64
+# More than 1 runs the handlers in that many processes, every chat is always handled by the same one.
+# The main process only receives the updates (in run_mode) and hands them over, see workers.py
+worker_processes: int = 1
+
+# Outgoing Bot API requests: overall and per chat requests per second, see rate_limit.OutboundScheduler
+outbound_global_rate: float = 30.0
+outbound_chat_rate: float = 1.0
+outbound_chat_burst: float = 3.0
+# A request is retried this many times after Telegram answered RetryAfter
+outbound_max_retries: int = 3
+
+# Unfinished forms are removed after this many seconds without a button press
+form_ttl_seconds: int = 6 * 60 * 60
+# At most this many unfinished forms are kept, the least recently used ones are removed first
+max_live_forms: int = 10000
+# How often expired forms are looked for (needs python-telegram-bot[job-queue])
+form_sweep_interval: int = 5 * 60
+
+# Chats allowed to use the admin commands (/stats, /search, /reload)
+admin_chat_ids: List[int] = []
+# Point this to a local stand-in (see fake_bot_api.py) to try things without Telegram
+bot_api_base_url: str = "https://api.telegram.org/bot"
 
-ROUND, JUDGE, TEAM, PLACE, RATE1, RATE2, RATE3, RATE4, FEEDBACK, CONFIRMATION = range(1, 11)
-no_feedback_str = "Нет отзыва"
 help_string = "Я бот для заполнения обратной формы на судей. Начать новую форму /start. " \
               "Если совершил ошибку можно начать новую форму повторно используя /start"
-choices_dict: Dict[int, List[str]] = {
-    ROUND: ["1", "2", "3", "4 Импрораунд"],
-    # 2 day: "5 Раунд", "Чвертьфинал", "Полуфинал", "Финал"
-    JUDGE: ["Aleksandra Jegorova", "Anastassia Serbina", "Anna Veiert", "David Rozenbllit", "Ilja Freiberg", "Ivan Pokrovski", "Kateryna Svyrhun", "Kirill Zaitsev", "Makar Ivashko", "Maksim Tjulenev", "Maxim Borodin", "Mykhailo Datsenko", "Vladimir Šulžik", "Vladislav Konstantinov"],
-    TEAM: ["Bratja Karamazovi", "Canon mg 2552s", "Capital of freezers", "Cringe", "DEBчата", "Kvaliteetne ja Kange", "Lidij", "Memories and Dreams", "Metilmetkatinon", "SKK", "Team Σ", "η - \"эта\"", "Ёнмоко не вылавировали", "Влад дед инсайд", "Гиппопотомомонстросесквиппедалиофобия", "Мы тут!", "Удар колбасой", "Униженные и оскорбленные"],
-    PLACE: ["Победили", "Проиграли"],
-    RATE1: ["1", "2", "3", "4", "5"],
-    RATE2: ["1", "2", "3", "4", "5"],
-    RATE3: ["1", "2", "3", "4"],
-    RATE4: ["Соблюдено", "Не соблюдено"],
-    FEEDBACK: [no_feedback_str],
-    CONFIRMATION: ["ДА", "НЕТ"],
-}
+# Questions, answer options and summary labels of the form, see form_config.FormConfig for the format.
+# The file is checked for changes every form_reload_interval seconds (0 turns it off, /reload still works),
+# forms that were already started keep the version they were started with
+form_filename = 'form.json'
+form_reload_interval: int = 10
+# Tournaments served by the bot: code -> directory with the tournament's own form_filename, output_filename
+# and chat_ids_filename ("" is the working directory). "" is the tournament of a plain /start, the others are
+# picked with the link https://t.me/<bot username>?start=<code> (or /start <code>), after that a plain /start
+# stays in the picked one. Codes are up to 64 letters, digits, "_" and "-" (a Telegram deep link limit)
+tournaments: Dict[str, str] = {"": ""}
 
-question_dict: Dict[int, str] = {
-    ROUND: "Выбери раунд:",
-    JUDGE: "Выбери судью:",
-    TEAM:  "Выбери свою команду:",
-    PLACE: "В раунде вы?",
-    RATE1: "1. Оцените анализ речей ваших судей. Здесь мы НЕ спрашиваем согласны ли вы с местами."
-           "\nКритерии: насколько анализ был понятным, логичным, детальным. Указал ли судья на основные пробелы рассказал ли, как их заполнить."
-           "\n1 - очень непонятно / необычайно странный анализ"
-           "\n5 - Всё понятно. Вряд ли можно проанализировать наши речи много лучше",
-    RATE2: "2. Насколько качественно проведено сравнение команд?"
-           "\nКритерии: "
-           "\n1. Наличие объяснения мест."
-           "\n2. Приведенные причины расстановки мест логичны, внутренне непротиворечивы, учитывают весь материал, который был на речах команд."
-           "\n1 - очень непонятно / крайне необычные критерии, которые мы не смогли понять"
-           "\n5 - Всё понятно, чётко, детально. Сомнений в верности полученных мест или хотя бы в их допустимости нет",
-    RATE3: "3. Был ли фидбэк полезен для вашего дальнейшего развития?"
-           "\nКритерии: - предложены новые аргументы или варианты улучшения аргументов. – советы по отбивке, структуре, тайм-менеджменту, расстановке акцентов."
-           "\n1 - Никаких предложений по улучшению не последовало"
-           "\n4 - Ясно, как выиграть этот раунд, если этого не произошло, или качественно повысить уровень речей, если раунд выигран",
-    RATE4: "Оцените введение раунда (соблюдение регламента, поддержание порядка)",
-    FEEDBACK: "Комментарий для главного судьи, необязательно (Отправь текстовое сообщение с отзывом, или нажми \"Нет отзыва\")",
-    CONFIRMATION: "Всё правильно?",
-}
-
-summary_dict: Dict[int, str] = {
-    ROUND: "Раунд:",
-    JUDGE: "Судья:",
-    TEAM:  "Команда:",
-    PLACE: "Результат:",
-    RATE1: "1. Анализ речей судьей:",
-    RATE2: "2. Сравнение команд:",
-    RATE3: "3. Полезность:",
-    RATE4: "Ведение раунда:",
-    FEEDBACK: "Комментарии:",
-}
+# Prometheus metrics on http://metrics_listen:metrics_port/metrics, 0 turns the endpoint off
+metrics_listen: str = "127.0.0.1"
+metrics_port: int = 0
+# Write all metrics into the log every N seconds, 0 turns it off
+metrics_log_interval: float = 0
+# Handler and API call timing, turned off only to measure its overhead
+metrics_enabled: bool = True
 
 # END SETTINGS
 ###############################################################
 
+handler_seconds = metrics.Histogram("bot_handler_seconds", "Time spent in update handlers", ["handler"])
+api_request_seconds = metrics.Histogram("bot_api_request_seconds", "Telegram Bot API call latency", ["endpoint"])
+api_errors = metrics.Counter("bot_api_errors_total", "Failed Telegram Bot API calls", ["endpoint", "error"])
+# Forms abandoned at a stage = reached that stage - reached the next one
+stage_reached = metrics.Counter("bot_form_stage_reached_total", "Forms that reached a stage", ["stage"])
+forms_finished = metrics.Counter("bot_forms_finished_total", "Forms answered at the confirmation", ["result"])
+forms_evicted = metrics.Counter("bot_forms_evicted_total", "Unfinished forms removed", ["reason", "stage"])
+sink_write_seconds = metrics.Histogram("bot_file_write_seconds", "Time to write and sync one batch of rows", ["file"])
+sink_rows = metrics.Counter("bot_file_rows_written_total", "Rows appended to files", ["file"])
+sink_errors = metrics.Counter("bot_file_write_errors_total", "Batches of rows that could not be written", ["file"])
+answers_load_seconds = metrics.Histogram("bot_answers_load_seconds", "Time to read the saved answers at startup",
+                                         ["tournament"])
+
+
+# Exclusive lock on a file while a batch is appended to it, so lines written by several worker processes
+# (see workers.py) never interleave. The file is opened for appending, so every batch lands at the end.
+# shared=True is for reading, it only waits for writers
+@contextlib.contextmanager
+def locked(file, shared: bool = False):
+    if fcntl is None:
+        yield
+        return
+    fcntl.flock(file.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+SINK_RETRY_SECONDS = 1.0
+# Attempts to write the last rows when the bot stops
+SINK_CLOSE_RETRIES = 5
+
+
+# Appends csv rows to a file from a background thread, so handlers never wait for the disk.
+# Rows queued within flush_interval of each other are written (and fsynced) as one batch.
+class CsvAppendSink:
+    def __init__(self, filename: str, header: List[str], flush_interval: float, fsync: bool) -> None:
+        self.filename = filename
+        self.header = header
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.queued_rows: int = 0
+        self.flushed_rows: int = 0
+        self._queue: "queue.SimpleQueue[Optional[List]]" = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+        # Set while batches can't be written, they are kept and retried
+        self.last_error: Optional[OSError] = None
+
+    @property
+    def pending_rows(self) -> int:
+        return self.queued_rows - self.flushed_rows
+
+    # False while writes fail or if the writer thread died
+    @property
+    def healthy(self) -> bool:
+        return self.last_error is None and (self._thread is None or self._thread.is_alive())
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"sink-{self.filename}", daemon=True)
+            self._thread.start()
 
-# save the answer
-def save_answers(m_dict: Dict[int, str], chat: telegram.Chat) -> None:
+    def put(self, row: List) -> None:
+        self.queued_rows += 1
+        self._queue.put(row)
+
+    # Writes everything still queued and stops the writer thread
+    def close(self) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        print(f"{self.filename}: {self.flushed_rows} rows written, {self.pending_rows} pending")
+
+    def _open(self):
+        file = open(self.filename, "a", newline='', encoding="utf-8")
+        try:
+            if self.header:
+                with locked(file):
+                    # Another process may have written the header already
+                    if os.fstat(file.fileno()).st_size == 0:
+                        csv.writer(file, lineterminator="\n").writerow(self.header)
+                        file.flush()
+        except OSError:
+            with contextlib.suppress(OSError):
+                file.close()
+            raise
+        return file
+
+    # Adds queued rows to `batch`: waits up to `wait` seconds (None is forever) for the first one,
+    # then collects whatever arrives during the flush interval. Returns True once the sink is closed
+    def _collect(self, batch: List, wait: Optional[float]) -> bool:
+        try:
+            row = self._queue.get(timeout=wait)
+        except queue.Empty:
+            return False
+        deadline = time.monotonic() + self.flush_interval
+        while row is not None:
+            batch.append(row)
+            timeout = deadline - time.monotonic()
+            try:
+                row = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                return False
+        return True
+
+    # A batch that can't be written (disk full, file removed, ...) is kept, the file is opened again and
+    # the batch is written with the rows that came since. A batch that failed halfway may be written
+    # twice, duplicate answers are dropped at startup and by --compact
+    def _run(self) -> None:
+        file = None
+        batch: List = []
+        stop = False
+        failures = 0
+        while batch or not stop:
+            if not stop:
+                stop = self._collect(batch, SINK_RETRY_SECONDS if failures else None)
+            elif failures:
+                time.sleep(SINK_RETRY_SECONDS)
+            if not batch:
+                continue
+            try:
+                if file is None:
+                    file = self._open()
+                with sink_write_seconds.time(self.filename), locked(file):
+                    csv.writer(file, lineterminator="\n").writerows(batch)
+                    file.flush()
+                    if self.fsync:
+                        os.fsync(file.fileno())
+            except OSError as error:
+                failures += 1
+                self.last_error = error
+                sink_errors.inc(self.filename)
+                logger.error("%d rows not written to %s: %s", len(batch), self.filename, error)
+                if file is not None:
+                    with contextlib.suppress(OSError):
+                        file.close()
+                    file = None
+                if stop and failures >= SINK_CLOSE_RETRIES:
+                    logger.error("Giving up, %d rows for %s are lost", len(batch), self.filename)
+                    break
+                continue
+            failures = 0
+            self.last_error = None
+            self.flushed_rows += len(batch)
+            sink_rows.inc(self.filename, amount=len(batch))
+            batch = []
+        if file is not None:
+            file.close()
+
+# Everything counted from the saved answers of one tournament: the statistics and the comment search.
+# An earlier answer with the same submission key is taken out when a new one is recorded
+class AnswerSet:
+    def __init__(self, win_value: str = "", compliant_value: str = "") -> None:
+        self.index = results.SubmissionIndex()
+        self.stats = results.AnswerStats(win_value, compliant_value)
+        self.comments = search.CommentIndex()
+
+    def record(self, row: List[str]) -> None:
+        if duplicate_answers == "reject" and self.index.get(row) is not None:
+            return
+        previous = self.index.put(row)
+        if previous is not None:
+            self.stats.remove(previous)
+        self.stats.add(row)
+        self.comments.add(row)
+
+
+# Set in worker processes, other processes append to the answers files as well
+answers_shared: bool = False
+
+
+# With several worker processes every one of them only records the answers it saves itself,
+# so /stats and /search first add the rows other workers appended to the answers file since the last call.
+# The startup load goes through here as well, so only rows written after it are read later.
+class SharedAnswers:
+    def __init__(self, filename: str, answers: AnswerSet) -> None:
+        self.filename = filename
+        self.offset = 0
+        self.answers = answers
+        self._refreshing = asyncio.Lock()
+
+    # Rows from the offset to where the file ends now. Writers append whole batches under the lock,
+    # so that is the end of a row. The rows are streamed, the file is large when read at startup
+    def read_new_rows(self) -> Iterator[List[str]]:
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, "rb") as file:
+            with locked(file, shared=True):
+                end = os.fstat(file.fileno()).st_size
+            file.seek(self.offset)
+
+            def lines() -> Iterator[str]:
+                while self.offset < end:
+                    line = file.readline(end - self.offset)
+                    if not line:
+                        return
+                    self.offset += len(line)
+                    yield line.decode("utf-8")
+
+            for row in csv.reader(lines()):
+                if len(row) >= len(results.HEADER) and row[results.TIMESTAMP_COL] != results.HEADER[results.TIMESTAMP_COL]:
+                    yield row
+
+    # The file is read in a thread, the rows are recorded on the event loop like the answers saved here.
+    # Rows this worker saved itself are recorded again, which changes nothing
+    async def refresh(self) -> None:
+        async with self._refreshing:
+            rows = await asyncio.get_running_loop().run_in_executor(None, lambda: list(self.read_new_rows()))
+            for row in rows:
+                self.answers.record(row)
+
+
+# save the answer, returns "saved", "replaced" (an earlier answer of the chat to the same round, judge and team)
+# or "duplicate" (not saved, see duplicate_answers)
+def save_answers(m_dict: Dict[int, str], chat: telegram.Chat, tenant: "Tenant", config: FormConfig) -> str:
     current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    result: str = f"{current_datetime},{chat.id},{chat.username},{chat.full_name},"
+    row: List[str] = [current_datetime, str(chat.id), chat.username or '', chat.full_name or '']
+
+    # Fixed column order, so a skipped stage leaves an empty cell instead of shifting the row
+    for stage in range(ROUND, CONFIRMATION + 1):
+        value = m_dict.get(stage, '')
+        if stage == FEEDBACK and value == config.no_feedback:
+            value = ''
+        row.append(value)
+
+    is_duplicate = tenant.answers.index.get(row) is not None
+    if is_duplicate and duplicate_answers == "reject":
+        print(f"Duplicate feedback rejected ({tenant}): {row}")
+        return "duplicate"
+    print(f"Completed feedback ({tenant}): {row}")
+    tenant.answer_sink.put(row)
+    tenant.answers.record(row)
+    return "replaced" if is_duplicate else "saved"
 
-    for answer in m_dict:
-        value = m_dict[answer]
-        if answer == FEEDBACK:
-            if m_dict[FEEDBACK] == no_feedback_str:
-                value = ''
-        result += f"{value},"
-    result = result[:-1]
-    result += "\n"
 
-    print("Completed feedback: " + result, end='')
-    # Open the file in append & read mode ('a+')
-    myfile = open(output_filename, "a")
-    myfile.write(result)
+SAVE_RESULT_TEXTS: Dict[str, str] = {
+    "saved": "Ответ сохранён",
+    "replaced": "Ответ сохранён вместо прошлого отзыва на этого судью за этот раунд",
+    "duplicate": "Ответ НЕ сохранён: отзыв на этого судью за этот раунд уже есть",
+}
+
+
+# One line of the summary shown above the question, empty for answers that are not shown
+def summary_line(stage: int, value: str, config: FormConfig) -> str:
+    if stage == CONFIRMATION or (stage == FEEDBACK and value == config.no_feedback):
+        return ""
+    if stage not in config.stages:
+        print("Unknown stage: " + str(stage))
+        return ""
+    return f"{config.stages[stage].summary} {value}\n"
 
 
 # Turn user answers into human-readable format
-def answers_to_str(m_dict: Dict[int, str]) -> str:
-    result: str = ""
-    for answer in m_dict:
-        if answer == CONFIRMATION:
-            continue
-        if answer == FEEDBACK:
-            if m_dict[FEEDBACK] == no_feedback_str:
-                continue
+def answers_to_str(m_dict: Dict[int, str], config: FormConfig) -> str:
+    return "".join(summary_line(stage, value, config) for stage, value in m_dict.items())
 
-        if answer in summary_dict:
-            result += f"{summary_dict[answer]} {m_dict[answer]}\n"
-        else:
-            print("Not in summary_dict: " + str(answer))
-    return result
 
+# The form itself lives once per user in user_data["form"]. Buttons only carry the stage, the option
+# and the form version (see form_config.CALLBACK_PATTERN), so every stage's keyboard is built once per version.
+# Buttons of older forms are told apart by the message they are under.
+# form["summary"] is answers_to_str of the answers so far, None when it has to be rebuilt.
+# form["tenant"] is the code of the tournament, forms saved before tournaments existed have none ("").
+def new_form(stage: int, version: str, tenant: str) -> Dict:
+    return {"answers": {}, "stage": stage, "version": version, "message_id": None, "summary": "", "tenant": tenant}
 
-# Here all UI text is generated (except for /start command)
-def get_text_and_reply_markup(stage: int, answers: Dict[int, str]) -> (str, InlineKeyboardMarkup):
-    text: str = ""
-    buttons: List[Tuple[str, Dict[int, str], int]] = []
-    if (stage in choices_dict) and (stage in question_dict):
-        text = question_dict[stage]
-        for options in choices_dict[stage]:
-            buttons.append((options, answers, stage))
+
+# None if the tournament is no longer served
+def form_tenant(form: Dict) -> Optional["Tenant"]:
+    return tenants.get(form.get("tenant", ""))
+
+
+def form_config(form: Dict) -> FormConfig:
+    return form_tenant(form).form_versions.get(form["version"])
+
+
+# Stages are answered in order, so a new answer only adds a line at the end of the summary.
+# Changing an earlier answer (the comment can be corrected at the confirmation) rebuilds it.
+def set_answer(form: Dict, stage: int, value: str) -> None:
+    answers: Dict[int, str] = form["answers"]
+    is_new = stage not in answers
+    answers[stage] = value
+    if is_new and form.get("summary") is not None:
+        form["summary"] += summary_line(stage, value, form_config(form))
     else:
-        print("Unhandled branch, stage=" + str(stage))
+        form["summary"] = None
 
-    reply_markup = InlineKeyboardMarkup.from_column(
-        [InlineKeyboardButton(button[0], callback_data=button) for button in buttons]
-    )
 
-    text_markup = f"Твой выбор:\n{answers_to_str(answers)}\n{text}"
-    return text_markup, reply_markup
+def form_summary(form: Dict) -> str:
+    # Forms saved by older versions of the bot have no summary
+    if form.get("summary") is None:
+        form["summary"] = answers_to_str(form["answers"], form_config(form))
+    return form["summary"]
+
+
+# Here all UI text is generated (except for /start command)
+def get_text_and_reply_markup(stage: int, form: Dict) -> (str, InlineKeyboardMarkup):
+    compiled = form_config(form).stages[stage]
+    text_markup = f"Твой выбор:\n{form_summary(form)}\n{compiled.question}"
+    return text_markup, compiled.reply_markup
+
+
+# Keeps track of when every unfinished form of a tournament was used last,
+# and removes expired and least recently used ones
+class FormSessions:
+    def __init__(self, ttl: int, max_forms: int) -> None:
+        self.ttl = ttl
+        self.max_forms = max_forms
+        # user id -> time of the last activity, oldest first
+        self.last_active: "OrderedDict[int, float]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.last_active)
+
+    def touch(self, application: Application, user_id: int, form: Dict) -> None:
+        form["touched"] = time.time()
+        self.restore(application, user_id, form["touched"])
+
+    # Also used for forms saved before the restart, which have to be restored oldest first
+    def restore(self, application: Application, user_id: int, touched: float) -> None:
+        self.last_active[user_id] = touched
+        self.last_active.move_to_end(user_id)
+        while len(self.last_active) > self.max_forms:
+            oldest, _ = self.last_active.popitem(last=False)
+            self.evict(application, oldest, "lru")
+
+    def finish(self, user_id: int) -> None:
+        self.last_active.pop(user_id, None)
+
+    def is_expired(self, form: Dict) -> bool:
+        return time.time() - form.get("touched", time.time()) > self.ttl
+
+    @staticmethod
+    def evict(application: Application, user_id: int, reason: str) -> None:
+        user_data = application.user_data.get(user_id)
+        form = user_data.pop("form", None) if user_data is not None else None
+        if form is not None:
+            forms_evicted.inc(reason, STAGE_NAMES.get(form["stage"], str(form["stage"])))
+            application.mark_data_for_update_persistence(user_ids=user_id)
+
+    async def sweep(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        threshold = time.time() - self.ttl
+        evicted = 0
+        while self.last_active:
+            user_id, last_active = next(iter(self.last_active.items()))
+            if last_active >= threshold:
+                break
+            self.last_active.popitem(last=False)
+            self.evict(context.application, user_id, "ttl")
+            evicted += 1
+        if evicted:
+            logger.info("Removed %d expired forms, %d unfinished forms left", evicted, len(self.last_active))
+
+
+# (worker index, number of workers) in worker processes, see workers.py
+worker_shard: Optional[Tuple[int, int]] = None
+
+
+# Users with an unfinished form are loaded from the persistence at startup, so forms abandoned before
+# a restart expire as well (see restore_form_sessions). Forms are filled in private chats, which have
+# the id of their user, so a worker only loads the users whose chat it handles (workers.shard)
+def preload_user_data(user_id: int, data: Dict) -> bool:
+    if worker_shard is not None and user_id % worker_shard[1] != worker_shard[0]:
+        return False
+    return data.get("form") is not None
+
+
+# Forms without "touched" were started before forms expired, they are removed by the next sweep
+def restore_form_sessions(application: Application) -> None:
+    forms = []
+    for user_id, user_data in application.user_data.items():
+        form = user_data.get("form")
+        if form is not None:
+            forms.append((form.get("touched", 0), user_id, form))
+    forms.sort(key=lambda item: item[:2])
+    for touched, user_id, form in forms:
+        tenant = form_tenant(form)
+        if tenant is None:
+            FormSessions.evict(application, user_id, "tenant")
+        else:
+            tenant.form_sessions.restore(application, user_id, touched)
+    if forms:
+        print(f"{len(forms)} unfinished forms restored")
+
+
+# Returns the user's unfinished form, or None if there is none, it has expired, its tournament is not served
+# any more or its form version is not known (e.g. started before a restart with a different form file)
+def get_live_form(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[Dict]:
+    form: Optional[Dict] = context.user_data.get("form")
+    if form is None:
+        return None
+    tenant = form_tenant(form)
+    reason = None
+    if tenant is None:
+        reason = "tenant"
+    elif tenant.form_sessions.is_expired(form):
+        reason = "ttl"
+    elif tenant.form_versions.get(form.get("version")) is None:
+        reason = "version"
+    if reason is not None:
+        if tenant is not None:
+            tenant.form_sessions.finish(update.effective_user.id)
+        FormSessions.evict(context.application, update.effective_user.id, reason)
+        form = None
+    return form
+
+
+# Telegram only accepts the answer for a few seconds. Presses that waited while the bot was restarting
+# are too old for that but are still handled
+async def answer_query(query: telegram.CallbackQuery) -> None:
+    try:
+        await query.answer()
+    except telegram.error.BadRequest as error:
+        logger.info("Button press not answered: %s", error)
+
+
+async def invalid_button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await answer_query(update.callback_query)
+    await update.effective_message.edit_text("Нерабочая кнопка. Чтобы начать новую форму используй /start")
+
+
+async def expired_form_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await answer_query(update.callback_query)
+    await update.effective_message.edit_text("Форма устарела. Чтобы начать новую форму используй /start")
 
 
 async def button_press_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    await query.answer()
+    form = get_live_form(update, context)
+    if form is None:
+        # Second tap on the confirmation, keep the result of the first one on the screen
+        if query.message is not None and query.message.message_id == context.user_data.get("finished_message_id"):
+            await answer_query(query)
+            return
+        await expired_form_callback(update, context)
+        return
+    m_stage, m_index, m_version = CALLBACK_PATTERN.match(query.data).groups()
+    m_stage, m_index = int(m_stage), int(m_index)
+    # Buttons of an older form
+    if form["version"] != m_version or query.message is None or query.message.message_id != form["message_id"]:
+        await invalid_button_callback(update, context)
+        return
+    # Double tap on a stage that is already answered, the message is being redrawn anyway
+    if form["stage"] != m_stage:
+        await answer_query(query)
+        return
+    tenant = form_tenant(form)
+    config = tenant.form_versions.get(form["version"])
+    if m_index >= len(config.stages[m_stage].choices):
+        await invalid_button_callback(update, context)
+        return
+
+    await answer_query(query)
+    tenant.form_sessions.touch(context.application, update.effective_user.id, form)
     # Save the answer
-    m_str, m_dict, m_stage = cast(Tuple[str, Dict[int, str], int], query.data)
-    m_dict[m_stage] = m_str
+    m_dict: Dict[int, str] = form["answers"]
+    set_answer(form, m_stage, config.stages[m_stage].choices[m_index])
 
     if m_stage != CONFIRMATION:
         # Progress Stage
-        text, reply_markup = get_text_and_reply_markup(m_stage + 1, m_dict)
-        context.user_data["key"] = (m_dict, m_stage + 1)
+        form["stage"] = m_stage + 1
+        stage_reached.inc(STAGE_NAMES[m_stage + 1])
+        text, reply_markup = get_text_and_reply_markup(m_stage + 1, form)
     else:
         # The last answer handling
+        del context.user_data["form"]
+        context.user_data["finished_message_id"] = form["message_id"]
+        tenant.form_sessions.finish(update.effective_user.id)
         reply_markup = InlineKeyboardMarkup.from_column([])
-        if m_dict[CONFIRMATION] == "ДА":
-            # Save answer here
-            text = f"Твой отзыв\n{answers_to_str(m_dict)}\nОтвет сохранён"
-            save_answers(m_dict, update.effective_chat)
+        if m_dict[CONFIRMATION] == config.confirm:
+            # Save answer here, duplicates are only known once the saved answers are read
+            await tenant.wait_loaded()
+            result = save_answers(m_dict, update.effective_chat, tenant, config)
+            forms_finished.inc(result)
+            text = f"Твой отзыв\n{form_summary(form)}\n{SAVE_RESULT_TEXTS[result]}"
         else:
+            forms_finished.inc("discarded")
             text = f"Ответ не был сохранён. Используй /start чтобы начать заново"
 
-    await query.edit_message_text(text=text, reply_markup=reply_markup)
-    context.drop_callback_data(query)
+    # Not awaited, so quick taps of the same user are not held up by the edit,
+    # the rate limiter keeps only the latest of the edits still waiting to be sent
+    context.application.create_task(query.edit_message_text(text=text, reply_markup=reply_markup), update=update)
 
 
-def try_add_chat_id_to_file(chat_id_int: int) -> None:
-    chat_id: str = str(chat_id_int)
-    print('Trying to add chat id to file = ' + str(chat_id) + ' ...')
-    with open('chat_ids.txt') as file:
-        for line in file:
-            if line == (chat_id + '\n'):
-                print('... already present in file')
-                return
-        file.close()
-    print('... added')
+# All chats that ever used /start, loaded once at startup.
+# Each line of chat_ids.txt is "chat_id,first_seen,last_seen,username" (times are unix seconds),
+# older files with a bare chat id per line are read as well.
+# The file is an append-only log, duplicates are merged and the file is rewritten on load.
+class ChatRegistry:
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        # chat_id -> (first_seen, last_seen, username)
+        self.chats: Dict[int, Tuple[int, int, str]] = {}
+        self.sink = CsvAppendSink(filename, [], answers_flush_interval, fsync=False)
 
-    file_object = open('chat_ids.txt', 'a')
-    file_object.write(chat_id + '\n')
-    file_object.close()
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self.chats
+
+    def __len__(self) -> int:
+        return len(self.chats)
+
+    # compact=False leaves the file as it is, for processes that share it with others
+    def load(self, compact: bool = True) -> None:
+        lines: int = 0
+        needs_rewrite: bool = False
+        if os.path.exists(self.filename):
+            with open(self.filename, newline='', encoding="utf-8") as file:
+                for fields in csv.reader(file):
+                    if not fields:
+                        continue
+                    lines += 1
+                    chat_id = int(fields[0])
+                    if len(fields) < 4:
+                        needs_rewrite = True
+                        first_seen, last_seen, username = 0, 0, ''
+                    else:
+                        first_seen, last_seen, username = int(fields[1]), int(fields[2]), fields[3]
+                    if chat_id in self.chats:
+                        # Later lines only move last_seen forward, legacy lines have no times at all
+                        old_first, old_last, old_username = self.chats[chat_id]
+                        first_seen = old_first or first_seen
+                        if last_seen < old_last:
+                            last_seen, username = old_last, old_username
+                    self.chats[chat_id] = (first_seen, last_seen, username)
+        if compact and (needs_rewrite or lines != len(self.chats)):
+            self._rewrite()
+        print(f"Loaded {len(self.chats)} chat ids ({lines} lines in {self.filename})")
+
+    def _rewrite(self) -> None:
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w", newline='', encoding="utf-8") as file:
+            writer = csv.writer(file, lineterminator="\n")
+            for chat_id, (first_seen, last_seen, username) in self.chats.items():
+                writer.writerow([chat_id, first_seen, last_seen, username])
+        os.replace(tmp_filename, self.filename)
+
+    # Returns True if the chat was not known before
+    def touch(self, chat: Chat) -> bool:
+        now = int(time.time())
+        is_new = chat.id not in self.chats
+        first_seen = now if is_new else self.chats[chat.id][0] or now
+        self.chats[chat.id] = (first_seen, now, chat.username or '')
+        self.sink.put([chat.id, first_seen, now, chat.username or ''])
+        return is_new
+
+    # Chat ids to broadcast to, optionally only chats active during the last seen_within seconds
+    def chat_ids(self, seen_within: int = 0) -> List[int]:
+        if seen_within <= 0:
+            return list(self.chats)
+        threshold = int(time.time()) - seen_within
+        return [chat_id for chat_id, (_, last_seen, _) in self.chats.items() if last_seen >= threshold]
+
+
+# One tournament: its form, saved answers, chats and unfinished forms. Every tournament has its own files,
+# writer threads and in-memory indexes, so a busy tournament or one with a long history
+# does not slow down the lookups and file writes of the others.
+class Tenant:
+    def __init__(self, code: str, directory: str) -> None:
+        self.code = code
+        self.form_filename = os.path.join(directory, form_filename)
+        self.output_filename = os.path.join(directory, output_filename)
+        self.form_versions = FormVersions(self.form_filename)
+        self.answer_sink = CsvAppendSink(self.output_filename, results.HEADER, answers_flush_interval, answers_fsync)
+        self.answers = AnswerSet()
+        # Set once the answers saved before the start are in self.answers
+        self.loaded = threading.Event()
+        self.shared_answers: Optional[SharedAnswers] = None
+        self.chat_registry = ChatRegistry(os.path.join(directory, chat_ids_filename))
+        self.form_sessions = FormSessions(form_ttl_seconds, max_live_forms)
+
+    def __str__(self) -> str:
+        return f"tournament {self.code!r}"
+
+    # Loads the form file if it changed since the last call, returns an error message if it can't be used
+    def reload_form(self) -> Optional[str]:
+        try:
+            if not self.form_versions.reload():
+                return None
+        except (OSError, ValueError) as error:
+            logger.error("Form not loaded from %s: %s", self.form_filename, error)
+            return f"{self.form_filename}: {error}"
+        config = self.form_versions.current
+        self.answers.stats.win_value = config.stages[PLACE].choices[0]
+        self.answers.stats.compliant_value = config.stages[RATE4].choices[0]
+        print(f"Form version {config.version} loaded from {self.form_filename}")
+        return None
+
+    # Statistics and comment search over all answers, see SharedAnswers
+    async def get_answers(self) -> AnswerSet:
+        await self.wait_loaded()
+        if self.shared_answers is not None:
+            await self.shared_answers.refresh()
+        return self.answers
+
+    # Starts the writer threads and reads the saved answers in the background, so the bot answers /start
+    # and the buttons right away. Nothing is saved before they are read (see wait_loaded),
+    # so the writer thread never appends to the file while it is read
+    def start(self) -> None:
+        self.answer_sink.start()
+        self.chat_registry.sink.start()
+        threading.Thread(target=self._load_answers, name=f"load-{self.output_filename}", daemon=True).start()
+
+    def _load_answers(self) -> None:
+        started = time.perf_counter()
+        try:
+            if answers_shared:
+                self.shared_answers = SharedAnswers(self.output_filename, self.answers)
+                rows = 0
+                for row in self.shared_answers.read_new_rows():
+                    self.answers.record(row)
+                    rows += 1
+            else:
+                rows = results.scan_results(self.output_filename, [self.answers.record])
+            print(f"Loaded {rows} answers from {self.output_filename}, "
+                  f"{len(self.answers.index)} after removing duplicates, in {time.perf_counter() - started:.2f} s")
+        except Exception:
+            logger.exception("Answers not loaded from %s, statistics and duplicates only count new answers",
+                             self.output_filename)
+        finally:
+            answers_load_seconds.observe(time.perf_counter() - started, self.code)
+            self.loaded.set()
+
+    async def wait_loaded(self) -> None:
+        if not self.loaded.is_set():
+            await asyncio.get_running_loop().run_in_executor(None, self.loaded.wait)
+
+    def close(self) -> None:
+        self.answer_sink.close()
+        self.chat_registry.sink.close()
+
+
+TENANT_CODE_PATTERN = re.compile(r"^[A-Za-z0-9_-]{0,64}$")
+
+
+# One Tenant per entry of `tournaments`, with the file names and form settings set at the time of the call
+def build_tenants() -> Dict[str, Tenant]:
+    return {code: Tenant(code, directory) for code, directory in tournaments.items()}
+
+
+# Worker processes build them again after applying their settings, see workers.worker_main
+tenants: Dict[str, Tenant] = build_tenants()
+metrics.Gauge("bot_answers_pending", "Answers queued but not written yet",
+              lambda: sum(tenant.answer_sink.pending_rows for tenant in tenants.values()))
+metrics.Gauge("bot_file_writers_failing", "Files that rows can't be written to at the moment",
+              lambda: sum(not sink.healthy for tenant in tenants.values()
+                          for sink in (tenant.answer_sink, tenant.chat_registry.sink)))
+metrics.Gauge("bot_comments_indexed", "Feedback comments in the search index",
+              lambda: sum(len(tenant.answers.comments) for tenant in tenants.values()))
+metrics.Gauge("bot_form_versions", "Form versions loaded since the start",
+              lambda: sum(len(tenant.form_versions.versions) for tenant in tenants.values()))
+metrics.Gauge("bot_live_forms", "Unfinished forms in memory",
+              lambda: sum(len(tenant.form_sessions) for tenant in tenants.values()))
+
+
+# Loads the form files of all tournaments if they changed, returns the error messages
+def reload_forms() -> List[str]:
+    return [error for error in (tenant.reload_form() for tenant in tenants.values()) if error is not None]
+
+
+async def reload_forms_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    reload_forms()
+
+
+# The tournament the user picked last with /start <code>
+def user_tenant(context: ContextTypes.DEFAULT_TYPE) -> Optional[Tenant]:
+    return tenants.get(context.user_data.get("tenant", ""))
+
+
+# Buttons under the /search results, "search:<page>"
+SEARCH_PAGE_PATTERN = re.compile(r"^search:(\d+)$")
+
+
+async def get_search_page(tenant: Tenant, query: str, page: int) -> (str, Optional[InlineKeyboardMarkup]):
+    matches = (await tenant.get_answers()).comments.search(query)
+    page = min(page, search.pages(matches) - 1)
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀", callback_data=f"search:{page - 1}"))
+    if page + 1 < search.pages(matches):
+        buttons.append(InlineKeyboardButton("▶", callback_data=f"search:{page + 1}"))
+    return search.render_page(query, matches, page), InlineKeyboardMarkup([buttons]) if buttons else None
 
 
 def setup_callbacks(application: Application) -> None:
@@ -193,52 +830,129 @@ def setup_callbacks(application: Application) -> None:
         chat = update.effective_chat
         result: str = f"{current_datetime},{chat.id},{chat.username},{chat.full_name}"
         print(f"New start command: {result}")
-        m_dict: Dict[int, str] = {}
-        try_add_chat_id_to_file(chat.id)
-        if len(choices_dict[ROUND]) != 0:
-            text_markup, reply_markup = get_text_and_reply_markup(ROUND, m_dict)
-            text_markup = question_dict[ROUND]
-        else:
-            text_markup, reply_markup = get_text_and_reply_markup(JUDGE, m_dict)
-            text_markup = question_dict[JUDGE]
-        await update.message.reply_text(text_markup, reply_markup=reply_markup)
+        # Deep link https://t.me/<bot>?start=<code>, otherwise the tournament used last
+        code = context.args[0] if context.args else context.user_data.get("tenant", "")
+        tenant = tenants.get(code)
+        if tenant is None:
+            await update.message.reply_text("Неизвестный турнир. Открой ссылку на бота, которую дали организаторы")
+            return
+        context.user_data["tenant"] = code
+        if tenant.chat_registry.touch(chat):
+            print(f"New chat id added to {tenant}: {chat.id}")
+        # The unfinished form being replaced may belong to another tournament
+        old_form = context.user_data.get("form")
+        if old_form is not None and form_tenant(old_form) is not None:
+            form_tenant(old_form).form_sessions.finish(update.effective_user.id)
+        config = tenant.form_versions.current
+        first_stage = config.first_stage
+        form = new_form(first_stage, config.version, code)
+        context.user_data["form"] = form
+        tenant.form_sessions.touch(context.application, update.effective_user.id, form)
+        stage_reached.inc(STAGE_NAMES[first_stage])
+        # Form stored by older versions of the bot together with the arbitrary callback data
+        context.user_data.pop("key", None)
+        compiled = config.stages[first_stage]
+        message = await update.message.reply_text(compiled.question, reply_markup=compiled.reply_markup)
+        form["message_id"] = message.message_id
 
     async def help_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text(help_string)
 
-    # async def clear_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    #     context.bot.callback_data_cache.clear_callback_data()
-    #     context.bot.callback_data_cache.clear_callback_queries()
-    #     await update.effective_message.reply_text("callback_data_cache cleared")
+    # Admin commands work with the tournament the admin picked last with /start <code>
+    async def admin_tenant(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[Tenant]:
+        if update.effective_chat.id not in admin_chat_ids:
+            await unknown_command_callback(update, context)
+            return None
+        tenant = user_tenant(context)
+        if tenant is None:
+            await update.message.reply_text("Сначала выбери турнир: /start <код турнира>")
+            return None
+        await tenant.wait_loaded()
+        return tenant
+
+    async def stats_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        tenant = await admin_tenant(update, context)
+        if tenant is None:
+            return
+        group = context.args[0] if context.args else "judge"
+        if group not in results.AnswerStats.GROUPS:
+            await update.message.reply_text(f"Используй /stats {' | '.join(results.AnswerStats.GROUPS)}")
+            return
+        await update.message.reply_text((await tenant.get_answers()).stats.to_str(group))
+
+    async def search_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        tenant = await admin_tenant(update, context)
+        if tenant is None:
+            return
+        query = " ".join(context.args)
+        if not search.terms(query):
+            await update.message.reply_text("Используй /search слова из отзыва, например /search опоздал")
+            return
+        # Kept for the page buttons
+        context.user_data["search"] = query
+        text, reply_markup = await get_search_page(tenant, query, 0)
+        await update.message.reply_text(text, reply_markup=reply_markup)
+
+    async def search_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        query = update.callback_query
+        search_query = context.user_data.get("search")
+        tenant = user_tenant(context)
+        if update.effective_chat.id not in admin_chat_ids or search_query is None or tenant is None:
+            await invalid_button_callback(update, context)
+            return
+        await answer_query(query)
+        text, reply_markup = await get_search_page(tenant, search_query,
+                                                   int(SEARCH_PAGE_PATTERN.match(query.data).group(1)))
+        await query.edit_message_text(text, reply_markup=reply_markup)
+
+    async def reload_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if update.effective_chat.id not in admin_chat_ids:
+            await unknown_command_callback(update, context)
+            return
+        errors = reload_forms()
+        versions = "\n".join(f"{tenant.code or '(без кода)'}: {tenant.form_versions.current.version}"
+                              for tenant in tenants.values())
+        if errors:
+            await update.message.reply_text("Не загружено, остались прежние версии:\n" + "\n".join(errors) +
+                                            f"\n\nВерсии форм:\n{versions}")
+            return
+        await update.message.reply_text(f"Версии форм:\n{versions}")
 
     async def unknown_command_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("Неизвестная команда, используй /help")
 
-    async def invalid_button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        await update.callback_query.answer()
-        await update.effective_message.edit_text("Нерабочая кнопка. Чтобы начать новую форму используй /start")
-
     async def text_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        m_dict, m_stage = context.user_data["key"]
-        if m_stage != FEEDBACK:
+        form = get_live_form(update, context)
+        # The comment can also be corrected while the confirmation is shown
+        if form is None or form["stage"] not in (FEEDBACK, CONFIRMATION):
             current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             chat = update.effective_chat
             result: str = f"Text is unsupported at the moment: {current_datetime},{chat.id},{chat.username},{chat.full_name},{update.message.text}"
             print(result)
             await update.message.reply_text("Сейчас текст не принимается, используй /help")
         else:
-            m_dict[FEEDBACK] = update.message.text
-            context.user_data["key"] = (m_dict, m_stage)
-            text, reply_markup = get_text_and_reply_markup(CONFIRMATION, m_dict)
-            await update.message.reply_text(text, reply_markup=reply_markup)
+            set_answer(form, FEEDBACK, update.message.text)
+            form_tenant(form).form_sessions.touch(context.application, update.effective_user.id, form)
+            if form["stage"] != CONFIRMATION:
+                form["stage"] = CONFIRMATION
+                stage_reached.inc(STAGE_NAMES[CONFIRMATION])
+            text, reply_markup = get_text_and_reply_markup(CONFIRMATION, form)
+            message = await update.message.reply_text(text, reply_markup=reply_markup)
+            # From now on the buttons under the new message are used
+            form["message_id"] = message.message_id
 
-    application.add_handler(CommandHandler("start", start_callback))
-    application.add_handler(CommandHandler("help", help_callback))
-    # application.add_handler(CommandHandler("clear", clear_callback))
-    application.add_handler(MessageHandler(filters.COMMAND, unknown_command_callback))
-    application.add_handler(CallbackQueryHandler(invalid_button_callback, pattern=InvalidCallbackData))
-    application.add_handler(CallbackQueryHandler(button_press_callback))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_callback))
+    timed = metrics.timed(handler_seconds) if metrics_enabled else lambda callback: callback
+    application.add_handler(CommandHandler("start", timed(start_callback)))
+    application.add_handler(CommandHandler("help", timed(help_callback)))
+    application.add_handler(CommandHandler("stats", timed(stats_callback)))
+    application.add_handler(CommandHandler("reload", timed(reload_callback)))
+    application.add_handler(CommandHandler("search", timed(search_callback)))
+    application.add_handler(MessageHandler(filters.COMMAND, timed(unknown_command_callback)))
+    application.add_handler(CallbackQueryHandler(timed(button_press_callback), pattern=CALLBACK_PATTERN))
+    application.add_handler(CallbackQueryHandler(timed(search_page_callback), pattern=SEARCH_PAGE_PATTERN))
+    # Anything else, e.g. buttons sent before an update of the bot
+    application.add_handler(CallbackQueryHandler(timed(invalid_button_callback)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed(text_callback)))
 
 
 def check_version() -> None:
@@ -261,46 +975,285 @@ def try_send_message_to_all_users() -> bool:
     if len(message_to_all_users) == 0:
         return False
 
-    async def send_and_wait(bot_token: str, chat_id: int, text: str):
-        application = ApplicationBuilder().token(bot_token).build()
-        await application.bot.sendMessage(chat_id=chat_id, text=text)
-    num_lines: int = 0
-    with open('chat_ids.txt') as file:
-        for line in file:
-            num_lines += 1
-        file.close()
-
-    if num_lines == 0:
-        print('File with ids has 0 lines, no recipients for the message')
+    # A chat in several tournaments gets the message once
+    seen_within = message_seen_within_days * 24 * 60 * 60
+    chat_ids = list(dict.fromkeys(chat_id for tenant in tenants.values()
+                                  for chat_id in tenant.chat_registry.chat_ids(seen_within)))
+    if len(chat_ids) == 0:
+        print('No known chat ids, no recipients for the message')
         return False
 
-    text = input(f'Going to send message {message_to_all_users} to {num_lines} users. Press Enter to confirm: ')
+    text = input(f'Going to send message {message_to_all_users} to {len(chat_ids)} users. Press Enter to confirm: ')
     print(f'Sending...')
 
-    with open('chat_ids.txt') as file:
-        for line in file:
-            chat_id = int(line[:-1])
-            asyncio.run(send_and_wait(TOKEN_STR, chat_id, message_to_all_users))
-        file.close()
+    import broadcast
+    asyncio.run(broadcast.broadcast(TOKEN_STR, bot_api_base_url, chat_ids, message_to_all_users,
+                                    broadcast_concurrency))
     print(f'Done')
     return True
 
 
-def main() -> None:
-    check_version()
+# Processes updates of different chats concurrently while updates of the same chat keep their order,
+# so a chat's form in user_data is never changed by two handlers at once
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int) -> None:
+        # BaseUpdateProcessor takes its slot before do_process_update, so updates waiting for their chat
+        # would hold slots and a chat with a backlog could take all of them. The limit is applied
+        # in do_process_update instead, once the update's chat is free
+        super().__init__(2 ** 30)
+        self.slots = asyncio.Semaphore(max_concurrent_updates)
+        # chat id -> (lock, number of updates holding or waiting for it)
+        self.chat_locks: Dict[int, Tuple[asyncio.Lock, int]] = {}
 
-    if try_send_message_to_all_users():
-        return
+    async def do_process_update(self, update: object, coroutine) -> None:
+        chat_id: Optional[int] = None
+        if isinstance(update, Update):
+            if update.effective_chat is not None:
+                chat_id = update.effective_chat.id
+            elif update.effective_user is not None:
+                chat_id = update.effective_user.id
+        if chat_id is None:
+            async with self.slots:
+                await coroutine
+            return
+
+        lock, users = self.chat_locks.get(chat_id, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self.chat_locks[chat_id] = (lock, users + 1)
+        try:
+            # asyncio.Lock wakes up waiters in the order they came
+            async with lock, self.slots:
+                await coroutine
+        finally:
+            lock, users = self.chat_locks[chat_id]
+            if users == 1:
+                del self.chat_locks[chat_id]
+            else:
+                self.chat_locks[chat_id] = (lock, users - 1)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+# Time spent in every startup step, printed once the bot takes updates.
+# The saved answers are read in the background and are not part of it (see Tenant.start)
+class StartupTimer:
+    def __init__(self, started: float) -> None:
+        self.started = started
+        self.last = started
+        self.steps: List[Tuple[str, float]] = []
 
-    application = (
+    def step(self, name: str) -> None:
+        now = time.perf_counter()
+        self.steps.append((name, now - self.last))
+        self.last = now
+
+    @property
+    def total(self) -> float:
+        return self.last - self.started
+
+    def to_str(self) -> str:
+        return f"Ready in {self.total:.2f} s: " + ", ".join(f"{name} {seconds:.2f}" for name, seconds in self.steps)
+
+
+startup = StartupTimer(startup_started)
+metrics.Gauge("bot_startup_seconds", "Time from the start of the process until updates were taken",
+              lambda: startup.total)
+
+
+# Runs after Application.initialize (getMe, persistence), right before updates are taken
+async def post_init(application: Application) -> None:
+    restore_form_sessions(application)
+    startup.step("initialize")
+    print(startup.to_str())
+
+
+async def post_shutdown(application: Application) -> None:
+    for tenant in tenants.values():
+        tenant.close()
+
+
+# Set by build_application
+outbound_scheduler: Optional[OutboundScheduler] = None
+metrics.Gauge("bot_outbound_queue_length", "Bot API requests waiting for their turn",
+              lambda: outbound_scheduler.queue_length() if outbound_scheduler else 0)
+
+
+# Measures every Bot API call made through the wrapped request
+class InstrumentedRequest(BaseRequest):
+    def __init__(self, request: BaseRequest) -> None:
+        self.request = request
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self.request.read_timeout
+
+    async def initialize(self) -> None:
+        await self.request.initialize()
+
+    async def shutdown(self) -> None:
+        await self.request.shutdown()
+
+    async def do_request(self, url: str, method: str, request_data=None, **timeouts) -> Tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, payload = await self.request.do_request(url, method, request_data, **timeouts)
+        except Exception as error:
+            api_errors.inc(endpoint, type(error).__name__)
+            raise
+        finally:
+            api_request_seconds.observe(time.perf_counter() - started, endpoint)
+        if status == 429:
+            api_errors.inc(endpoint, "RetryAfter")
+        elif status >= 400:
+            api_errors.inc(endpoint, str(status))
+        return status, payload
+
+
+# request_factory replaces the HTTP layer, e.g. with fake_bot_api.FakeRequest for benchmarks
+def build_application(request_factory: Optional[Callable[[], BaseRequest]] = None) -> Application:
+    global outbound_scheduler
+    outbound_scheduler = OutboundScheduler(outbound_global_rate, outbound_chat_rate, outbound_chat_burst,
+                                           outbound_max_retries)
+    builder = (
         Application.builder()
         .token(TOKEN_STR)
-        .persistence(PicklePersistence(filepath="debate_test_bot.picklepersistence"))
-        .arbitrary_callback_data(True)
-        .build()
+        .base_url(bot_api_base_url)
+        .persistence(SqlitePersistence(persistence_filename, preload_user_data=preload_user_data))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .concurrent_updates(PerChatUpdateProcessor(max_concurrent_updates))
+        .rate_limiter(outbound_scheduler)
     )
+    if request_factory is None:
+        # Every update waits for at most one request, the message edit is sent in the background
+        request_factory = lambda: HTTPXRequest(connection_pool_size=2 * max_concurrent_updates)
+    if metrics_enabled:
+        builder = builder.request(InstrumentedRequest(request_factory()))
+        builder = builder.get_updates_request(InstrumentedRequest(request_factory()))
+    else:
+        builder = builder.request(request_factory()).get_updates_request(request_factory())
+    application = builder.build()
     setup_callbacks(application)
-    application.run_polling()
+    if application.job_queue is not None:
+        for tenant in tenants.values():
+            application.job_queue.run_repeating(tenant.form_sessions.sweep, interval=form_sweep_interval,
+                                                first=form_sweep_interval)
+        if form_reload_interval:
+            application.job_queue.run_repeating(reload_forms_job, interval=form_reload_interval,
+                                                first=form_reload_interval)
+    else:
+        logger.warning("No job queue, expired forms are only removed when they are used. "
+                       "Install python-telegram-bot[job-queue] to remove them in the background")
+    return application
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Debate judge feedback bot")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default=run_mode)
+    parser.add_argument("--listen", default=webhook_listen, help="webhook mode: address of the local server")
+    parser.add_argument("--port", type=int, default=webhook_port, help="webhook mode: port of the local server")
+    parser.add_argument("--path", default=webhook_path, help="webhook mode: url path of the local server")
+    parser.add_argument("--webhook-url", default=webhook_url, help="webhook mode: public url given to Telegram")
+    parser.add_argument("--secret-token", default=webhook_secret_token, help="webhook mode: shared secret")
+    parser.add_argument("--workers", type=int, default=worker_processes,
+                        help="processes handling updates, see workers.py")
+    parser.add_argument("--compact", action="store_true",
+                        help="remove duplicate answers from the answers file and exit, the bot must not be running")
+    return parser.parse_args()
+
+
+# Checks the tournaments setting, returns an error message
+def check_tournaments() -> Optional[str]:
+    for code, directory in tournaments.items():
+        if not TENANT_CODE_PATTERN.match(code):
+            return f"Tournament code {code!r} can't be used in a link, use up to 64 letters, digits, _ and -"
+        if directory and not os.path.isdir(directory):
+            return f"No directory {directory!r} for tournament {code!r}"
+    return None
+
+
+# Checks the webhook settings, returns an error message. Without a public url the webhook would be
+# registered at the local server's address, which Telegram can't reach
+def check_webhook(args: argparse.Namespace) -> Optional[str]:
+    if args.mode != "webhook":
+        return None
+    if not args.webhook_url:
+        return "Webhook mode needs the public url Telegram sends updates to, set --webhook-url or webhook_url"
+    if not args.secret_token:
+        logger.warning("No webhook secret token, anybody who finds the url can send updates. "
+                       "Set --secret-token or webhook_secret_token")
+    return None
+
+
+# compact=False leaves the files as they are, for processes that share them with others
+def load_chat_registries(compact: bool = True) -> None:
+    for tenant in tenants.values():
+        tenant.chat_registry.load(compact)
+
+
+# Reads the answers and starts the writer threads and metrics, everything needed before build_application
+def start_services() -> None:
+    for tenant in tenants.values():
+        tenant.start()
+    if metrics_port:
+        metrics.start_http_server(metrics_listen, metrics_port)
+        print(f"Metrics on http://{metrics_listen}:{metrics_port}/metrics")
+    if metrics_log_interval:
+        metrics.start_log_dump(metrics_log_interval, logger)
+
+
+def main() -> None:
+    startup.step("imports")
+    args = parse_args()
+    check_version()
+    error = check_tournaments()
+    if error is not None:
+        raise SystemExit(error)
+    if args.compact:
+        for tenant in tenants.values():
+            kept, dropped = results.compact_results(tenant.output_filename, latest=duplicate_answers != "reject")
+            print(f"{tenant.output_filename}: kept {kept} answers, removed {dropped} duplicates")
+        return
+    error = check_webhook(args)
+    if error is not None:
+        raise SystemExit(error)
+    load_chat_registries()
+    startup.step("chat ids")
+
+    if try_send_message_to_all_users():
+        return
+
+    if not os.path.exists(persistence_filename) and os.path.exists(pickle_persistence_filename):
+        migrate_pickle(pickle_persistence_filename, persistence_filename)
+        startup.step("persistence migration")
+
+    errors = reload_forms()
+    if errors:
+        raise SystemExit("Can't load the forms: " + "; ".join(errors))
+    startup.step("forms")
+
+    if args.workers > 1:
+        import workers
+        workers.run(args.workers, args.mode, {
+            "listen": args.listen, "port": args.port, "url_path": args.path,
+            "webhook_url": args.webhook_url, "secret_token": args.secret_token or None})
+        return
+
+    start_services()
+    startup.step("services")
+    application = build_application()
+    startup.step("application")
+    if args.mode == "webhook":
+        application.run_webhook(listen=args.listen, port=args.port, url_path=args.path,
+                                webhook_url=args.webhook_url, secret_token=args.secret_token or None)
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
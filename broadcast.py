@@ -0,0 +1,133 @@
+import asyncio
+import csv
+import hashlib
+import os
+import time
+from typing import Dict, List, Set
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
+
+from rate_limit import KeyedTokenBuckets, TokenBucket, retry_after_seconds
+
+# Telegram allows about 30 messages per second overall and 1 per second into the same chat
+GLOBAL_RATE: float = 25.0
+PER_CHAT_RATE: float = 1.0
+MAX_NETWORK_RETRIES: int = 3
+PROGRESS_INTERVAL: float = 5.0
+
+# Recipients with these statuses are not retried when an interrupted broadcast is resumed
+FINAL_STATUSES = ("ok", "blocked", "failed")
+
+
+# One checkpoint file per message text, so a new message never skips anybody.
+# It is removed once everybody got a final status, so the same text can be sent again later
+def checkpoint_filename(text: str) -> str:
+    digest = hashlib.sha1(text.encode("utf-8")).hexdigest()[:10]
+    return f"broadcast_{digest}.csv"
+
+
+def load_checkpoint(filename: str) -> Set[int]:
+    done: Set[int] = set()
+    if os.path.exists(filename):
+        with open(filename, newline='', encoding="utf-8") as file:
+            for fields in csv.reader(file):
+                if len(fields) >= 2 and fields[1] in FINAL_STATUSES:
+                    done.add(int(fields[0]))
+    return done
+
+
+class Broadcast:
+    def __init__(self, bot: Bot, text: str, checkpoint: str, concurrency: int) -> None:
+        self.bot = bot
+        self.text = text
+        self.checkpoint = checkpoint
+        self.concurrency = concurrency
+        self.global_bucket = TokenBucket(GLOBAL_RATE, capacity=GLOBAL_RATE)
+        self.chat_buckets = KeyedTokenBuckets(PER_CHAT_RATE)
+        self.statuses: Dict[str, int] = {}
+        self.total = 0
+        self.done = 0
+        self.started = 0.0
+
+    async def send_one(self, chat_id: int) -> str:
+        network_errors = 0
+        while True:
+            await self.chat_buckets.acquire(chat_id)
+            await self.global_bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=self.text)
+                return "ok"
+            except RetryAfter as error:
+                # Flood control applies to the whole bot, so everybody waits
+                self.global_bucket.pause(retry_after_seconds(error))
+            except Forbidden:
+                return "blocked"
+            except BadRequest as error:
+                print(f"{chat_id}: {error}")
+                return "failed"
+            except NetworkError as error:
+                network_errors += 1
+                if network_errors > MAX_NETWORK_RETRIES:
+                    print(f"{chat_id}: {error}")
+                    return "error"
+                await asyncio.sleep(network_errors)
+
+    def print_progress(self) -> None:
+        elapsed = time.monotonic() - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - self.done) / rate if rate > 0 else 0.0
+        print(f"Sent {self.done}/{self.total}, {rate:.1f} msg/s, ETA {eta:.0f} s, {self.statuses}")
+
+    async def run(self, chat_ids: List[int]) -> Dict[str, int]:
+        self.total = len(chat_ids)
+        self.started = time.monotonic()
+        recipients: "asyncio.Queue[int]" = asyncio.Queue()
+        for chat_id in chat_ids:
+            recipients.put_nowait(chat_id)
+
+        with open(self.checkpoint, "a", newline='', encoding="utf-8") as file:
+            writer = csv.writer(file, lineterminator="\n")
+
+            async def worker() -> None:
+                while not recipients.empty():
+                    chat_id = recipients.get_nowait()
+                    status = await self.send_one(chat_id)
+                    writer.writerow([chat_id, status])
+                    self.statuses[status] = self.statuses.get(status, 0) + 1
+                    self.done += 1
+
+            async def progress() -> None:
+                while True:
+                    await asyncio.sleep(PROGRESS_INTERVAL)
+                    file.flush()
+                    self.print_progress()
+
+            progress_task = asyncio.create_task(progress())
+            try:
+                await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+            finally:
+                progress_task.cancel()
+        self.print_progress()
+        return self.statuses
+
+
+# Sends `text` to every chat in `chat_ids` that is not yet done according to the checkpoint file.
+# A single Bot (and HTTP connection pool) is shared by all sends.
+# The checkpoint stays if the broadcast was interrupted or some chats are to be retried.
+async def broadcast(token: str, base_url: str, chat_ids: List[int], text: str, concurrency: int) -> Dict[str, int]:
+    checkpoint = checkpoint_filename(text)
+    done = load_checkpoint(checkpoint)
+    remaining = [chat_id for chat_id in chat_ids if chat_id not in done]
+    if done:
+        print(f"Resuming from {checkpoint}: {len(done)} already done, {len(remaining)} left")
+
+    request = HTTPXRequest(connection_pool_size=concurrency)
+    async with Bot(token, base_url=base_url, request=request) as bot:
+        statuses = await Broadcast(bot, text, checkpoint, concurrency).run(remaining)
+    if all(status in FINAL_STATUSES for status in statuses):
+        os.remove(checkpoint)
+    else:
+        print(f"Not everybody got the message, run the broadcast again to retry them ({checkpoint})")
+    return statuses
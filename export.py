@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Per-judge reports from an answers file (the layout of results.HEADER), for files of any size.
+The file is memory-mapped and cut into chunks at row boundaries, every chunk is parsed and counted on its own,
+optionally in a pool of processes, and only the totals and one chunk's comments are in memory at a time.
+Written into the output directory:
+summary.txt        - all answers, every judge and every round
+judges/<judge>.txt - the judge's totals, per round, and all comments on the judge
+Every row of the file is counted, run `python bot.py --compact` first to drop replaced answers.
+Run:
+python export.py answers_out.csv --form form.json --out reports --processes 4
+"""
+import argparse
+import csv
+import io
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import time
+from collections import Counter
+from operator import itemgetter
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from form_config import PLACE, RATE4, FormVersions
+from results import (FEEDBACK_COL, HEADER, JUDGE_COL, PLACE_COL, RATE1_COL, RATE2_COL, RATE3_COL, RATE4_COL,
+                     ROUND_COL, TEAM_COL, TIMESTAMP_COL, Aggregate)
+
+CHUNK_SIZE = 4 * 1024 * 1024
+# The columns an Aggregate looks at, rows equal in all of them are counted together
+SUMMARY_COLS = (JUDGE_COL, ROUND_COL, PLACE_COL, RATE1_COL, RATE2_COL, RATE3_COL, RATE4_COL)
+JudgeRound = Tuple[str, str]
+
+
+# (start, end) byte ranges of the chunks, every one ends at the end of a row. A newline inside a quoted
+# comment is not the end of a row, the number of quotes before a row boundary is always even.
+def chunk_bounds(data: mmap.mmap, chunk_size: int) -> List[Tuple[int, int]]:
+    bounds = []
+    start = 0
+    while start < len(data):
+        end = min(start + chunk_size, len(data))
+        quotes = data[start:end].count(b'"')
+        while end < len(data):
+            newline = data.find(b"\n", end)
+            if newline == -1:
+                end = len(data)
+                break
+            quotes += data[end:newline + 1].count(b'"')
+            end = newline + 1
+            if quotes % 2 == 0:
+                break
+        bounds.append((start, end))
+        release(data, start, end)
+        start = end
+    return bounds
+
+
+# Pages of the mapped file that were read count as memory of the process until they are dropped
+def release(data: mmap.mmap, start: int, end: int) -> None:
+    if hasattr(mmap, "MADV_DONTNEED"):
+        start -= start % mmap.PAGESIZE
+        data.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+
+def read_chunk(filename: str, start: int, end: int) -> Iterator[List[str]]:
+    with open(filename, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        text = data[start:end].decode("utf-8")
+    for row in csv.reader(io.StringIO(text, newline='')):
+        if len(row) >= len(HEADER) and row[TIMESTAMP_COL] != HEADER[TIMESTAMP_COL]:
+            yield row
+
+
+# Counts one chunk, returns (rows, totals per judge and round, comments per judge ready to be written)
+def export_chunk(task: Tuple[str, int, int, str, str]) -> Tuple[int, Dict[JudgeRound, Aggregate], Dict[str, str]]:
+    filename, start, end, win_value, compliant_value = task
+    rows = list(read_chunk(filename, start, end))
+    # Ratings take a handful of values, so a chunk has far fewer distinct combinations than rows.
+    # They are counted in C and every combination is added once, with its count
+    combinations = Counter(map(itemgetter(*SUMMARY_COLS), rows))
+    aggregates: Dict[JudgeRound, Aggregate] = {}
+    row = [""] * len(HEADER)
+    for values, count in combinations.items():
+        for col, value in zip(SUMMARY_COLS, values):
+            row[col] = value
+        key = (row[JUDGE_COL], row[ROUND_COL])
+        if key not in aggregates:
+            aggregates[key] = Aggregate()
+        aggregates[key].add(row, win_value, compliant_value, count)
+
+    comments: Dict[str, List[str]] = {}
+    for row in rows:
+        if row[FEEDBACK_COL].strip():
+            comments.setdefault(row[JUDGE_COL], []).append(
+                f"Раунд {row[ROUND_COL]} | {row[TEAM_COL]} | {row[TIMESTAMP_COL]}\n{row[FEEDBACK_COL]}\n\n")
+    return len(rows), aggregates, {judge: "".join(texts) for judge, texts in comments.items()}
+
+
+# A file name for every judge, judges whose names only differ in characters a file name can't have get a number
+class JudgeFiles:
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.filenames: Dict[str, str] = {}
+        self.used = set()
+
+    def get(self, judge: str) -> str:
+        if judge not in self.filenames:
+            name = re.sub(r"[^\w.-]+", "_", judge).strip("._") or "_"
+            unique, number = name, 1
+            while unique.casefold() in self.used:
+                number += 1
+                unique = f"{name}_{number}"
+            self.used.add(unique.casefold())
+            self.filenames[judge] = os.path.join(self.directory, unique + ".txt")
+        return self.filenames[judge]
+
+
+def merged(aggregates: Dict[JudgeRound, Aggregate], key: Callable = itemgetter(0)) -> Dict[str, Aggregate]:
+    result: Dict[str, Aggregate] = {}
+    for judge_round, aggregate in aggregates.items():
+        name = key(judge_round)
+        if name not in result:
+            result[name] = Aggregate()
+        result[name].merge(aggregate)
+    return result
+
+
+def write_summary(filename: str, total: Aggregate, judges: Dict[str, Aggregate],
+                  rounds: Dict[str, Aggregate]) -> None:
+    with open(filename, "w", encoding="utf-8") as file:
+        file.write(f"Всего: {total.to_str()}\n\nСудьи:\n")
+        for judge, aggregate in sorted(judges.items()):
+            file.write(f"{judge}: {aggregate.to_str()}\n")
+        file.write("\nРаунды:\n")
+        for round_, aggregate in sorted(rounds.items()):
+            file.write(f"{round_}: {aggregate.to_str()}\n")
+
+
+# Streams `filename` into reports in `out`, returns (rows, judges)
+def export_results(filename: str, out: str, win_value: str, compliant_value: str, processes: int = 1,
+                   chunk_size: int = CHUNK_SIZE, progress: bool = True) -> Tuple[int, int]:
+    judges_directory = os.path.join(out, "judges")
+    os.makedirs(judges_directory, exist_ok=True)
+    size = os.path.getsize(filename)
+    bounds: List[Tuple[int, int]] = []
+    if size:
+        with open(filename, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            bounds = chunk_bounds(data, chunk_size)
+    tasks = [(filename, start, end, win_value, compliant_value) for start, end in bounds]
+
+    aggregates: Dict[JudgeRound, Aggregate] = {}
+    files = JudgeFiles(judges_directory)
+    # Comments go into <judge>.txt.part as the chunks are done and are put under the totals at the end
+    started_parts = set()
+    rows = 0
+    done = 0
+    started = time.perf_counter()
+    pool = multiprocessing.get_context("spawn").Pool(processes) if processes > 1 else None
+    try:
+        # In file order, so the comments keep their order
+        results = pool.imap(export_chunk, tasks) if pool is not None else map(export_chunk, tasks)
+        for (start, end), (chunk_rows, chunk_aggregates, comments) in zip(bounds, results):
+            rows += chunk_rows
+            for key, aggregate in chunk_aggregates.items():
+                if key in aggregates:
+                    aggregates[key].merge(aggregate)
+                else:
+                    aggregates[key] = aggregate
+            for judge, text in comments.items():
+                part = files.get(judge) + ".part"
+                with open(part, "a" if part in started_parts else "w", encoding="utf-8") as file:
+                    file.write(text)
+                started_parts.add(part)
+            done += end - start
+            if progress:
+                elapsed = time.perf_counter() - started
+                print(f"\r{done * 100 // size}% {done / 2 ** 20:.0f}/{size / 2 ** 20:.0f} MB, {rows} rows, "
+                      f"{rows / elapsed if elapsed else 0:.0f} rows/s", end="", file=sys.stderr, flush=True)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if progress:
+        print(file=sys.stderr)
+
+    judges = merged(aggregates)
+    rounds = merged(aggregates, itemgetter(1))
+    total = Aggregate()
+    for aggregate in judges.values():
+        total.merge(aggregate)
+    write_summary(os.path.join(out, "summary.txt"), total, judges, rounds)
+    for judge, aggregate in judges.items():
+        report = files.get(judge)
+        with open(report, "w", encoding="utf-8") as file:
+            file.write(f"{judge}\nВсего: {aggregate.to_str()}\n\n")
+            for (name, round_), judge_round in sorted(aggregates.items()):
+                if name == judge:
+                    file.write(f"Раунд {round_}: {judge_round.to_str()}\n")
+            part = report + ".part"
+            if part in started_parts:
+                file.write("\nОтзывы:\n\n")
+                with open(part, encoding="utf-8") as comments:
+                    shutil.copyfileobj(comments, file)
+                os.remove(part)
+    return rows, len(judges)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("filename", nargs="?", default="answers_out.csv")
+    parser.add_argument("--form", default="form.json", help="the form the answers were given to, for the "
+                                                            "values counted as a win and as compliant")
+    parser.add_argument("--out", default="reports", help="directory for the reports")
+    parser.add_argument("--processes", type=int, default=1, help="chunks are counted in that many processes")
+    parser.add_argument("--chunk-mb", type=float, default=CHUNK_SIZE / 2 ** 20)
+    args = parser.parse_args()
+    form_versions = FormVersions(args.form)
+    try:
+        form_versions.reload()
+    except (OSError, ValueError) as error:
+        sys.exit(f"Can't load the form from {args.form}: {error}")
+    config = form_versions.current
+    started = time.perf_counter()
+    rows, judges = export_results(args.filename, args.out, config.stages[PLACE].choices[0],
+                                  config.stages[RATE4].choices[0], args.processes, int(args.chunk_mb * 2 ** 20))
+    print(f"{rows} answers, {judges} judges in {time.perf_counter() - started:.1f} s, reports in {args.out}")
+
+
+if __name__ == "__main__":
+    main()
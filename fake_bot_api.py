@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the Telegram Bot API, for trying the broadcast and load tests without a real bot.
+Run:
+python fake_bot_api.py --port 8081
+and set bot_api_base_url = "http://127.0.0.1:8081/bot" in bot.py
+
+FakeRequest answers the same way without any network, for driving an Application in-process.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from telegram.request import BaseRequest, RequestData
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+# Like in Telegram, message ids are counted per chat: the n-th message sent into a chat has id n
+_message_ids: Dict[int, int] = {}
+_message_ids_lock = threading.Lock()
+
+
+def next_message_id(chat_id: int) -> int:
+    with _message_ids_lock:
+        _message_ids[chat_id] = _message_ids.get(chat_id, 0) + 1
+        return _message_ids[chat_id]
+
+
+def fake_message(params: Dict) -> Dict:
+    chat_id = int(params.get("chat_id", 0))
+    return {
+        "message_id": int(params.get("message_id") or next_message_id(chat_id)),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": BOT_USER,
+        "text": params.get("text", ""),
+    }
+
+
+# Returns (http status, response body) for a Bot API call
+def fake_response(method: str, params: Dict) -> Tuple[int, Dict]:
+    method = method.lower()
+    if method == "getme":
+        return 200, {"ok": True, "result": BOT_USER}
+    if method == "getupdates":
+        return 200, {"ok": True, "result": []}
+    if method in ("sendmessage", "editmessagetext", "editmessagereplymarkup"):
+        return 200, {"ok": True, "result": fake_message(params)}
+    return 200, {"ok": True, "result": True}
+
+
+# In-process replacement for HTTPXRequest, keeps the last keyboard sent to every chat
+class FakeRequest(BaseRequest):
+    def __init__(self) -> None:
+        self.calls: Dict[str, int] = {}
+        # chat id -> reply_markup of the last message sent or edited in that chat
+        self.last_markup: Dict[int, Optional[Dict[str, Any]]] = {}
+        # chat id -> id of the last message sent into that chat
+        self.last_message_id: Dict[int, int] = {}
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> Tuple[int, bytes]:
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        if "chat_id" in params and endpoint.lower() in ("sendmessage", "editmessagetext"):
+            self.last_markup[int(params["chat_id"])] = params.get("reply_markup")
+        status, response = fake_response(endpoint, params)
+        if endpoint.lower() == "sendmessage":
+            self.last_message_id[int(params["chat_id"])] = response["result"]["message_id"]
+        return status, json.dumps(response).encode("utf-8")
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    server: "FakeBotApiServer"
+    # Keep-alive, like api.telegram.org. Headers and body are written separately,
+    # with Nagle's algorithm every answer on a reused connection would wait for the delayed ACK
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf-8")
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(body or "{}")
+        else:
+            params = dict(parse_qsl(body))
+        method = self.path.rsplit("/", 1)[-1]
+        status, response = self.server.respond(method, params)
+        data = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class FakeBotApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Bots open many connections at once, the default backlog of 5 makes some of them fail
+    request_queue_size = 256
+
+    def __init__(self, host: str, port: int, latency: float = 0.0, flood_rate: float = 0.0,
+                 blocked_chat_ids: Optional[set] = None) -> None:
+        super().__init__((host, port), FakeBotApiHandler)
+        self.latency = latency
+        # Share of requests answered with 429 Too Many Requests
+        self.flood_rate = flood_rate
+        self.blocked_chat_ids = blocked_chat_ids or set()
+        self.calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def respond(self, method: str, params: Dict) -> Tuple[int, Dict]:
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.flood_rate and random.random() < self.flood_rate:
+            return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                         "parameters": {"retry_after": 1}}
+        if params.get("chat_id") and int(params["chat_id"]) in self.blocked_chat_ids:
+            return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+        return fake_response(method, params)
+
+    def start_in_thread(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, name="fake-bot-api", daemon=True)
+        thread.start()
+        return thread
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before every answer")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of requests answered with 429")
+    args = parser.parse_args()
+
+    server = FakeBotApiServer(args.host, args.port, args.latency, args.flood_rate)
+    print(f"Fake Bot API listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"Calls: {server.calls}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import re
+from typing import Dict, List, Optional
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# Stages of the feedback form, in the order they are asked. The numbers are part of the callback data
+# and every stage has its own column in answers_out.csv (see results.HEADER), so they never change.
+ROUND, JUDGE, TEAM, PLACE, RATE1, RATE2, RATE3, RATE4, FEEDBACK, CONFIRMATION = range(1, 11)
+STAGE_NAMES: Dict[int, str] = {ROUND: "ROUND", JUDGE: "JUDGE", TEAM: "TEAM", PLACE: "PLACE", RATE1: "RATE1",
+                               RATE2: "RATE2", RATE3: "RATE3", RATE4: "RATE4", FEEDBACK: "FEEDBACK",
+                               CONFIRMATION: "CONFIRMATION"}
+
+# Button callback data is "SSIIIVVVVVVVV": 2 digit stage, 3 digit option index and the form version
+CALLBACK_PATTERN = re.compile(r"^(\d{2})(\d{3})([0-9a-f]{8})$")
+
+# Telegram shows at most 100 buttons under a message
+MAX_CHOICES = 100
+
+
+def encode_callback_data(stage: int, index: int, version: str) -> str:
+    return f"{stage:02d}{index:03d}{version}"
+
+
+# Question, summary label and answer options of one stage, with the keyboard built once
+class CompiledStage:
+    __slots__ = ("question", "summary", "choices", "reply_markup")
+
+    def __init__(self, stage: int, version: str, question: str, summary: str, choices: List[str]) -> None:
+        self.question = question
+        self.summary = summary
+        self.choices = choices
+        self.reply_markup = InlineKeyboardMarkup.from_column(
+            [InlineKeyboardButton(option, callback_data=encode_callback_data(stage, index, version))
+             for index, option in enumerate(choices)])
+
+
+# One version of the form. The json file looks like
+# {"stages": {"ROUND": {"question": "Выбери раунд:", "summary": "Раунд:", "choices": ["1", "2"]}, ...}}
+# The first FEEDBACK choice means "no comment", the first CONFIRMATION choice saves the answer.
+# ROUND may have no choices, the form then starts with JUDGE.
+class FormConfig:
+    def __init__(self, data: Dict, version: str) -> None:
+        self.version = version
+        self.stages: Dict[int, CompiledStage] = {}
+        stages = data.get("stages") if isinstance(data, dict) else None
+        if not isinstance(stages, dict):
+            raise ValueError('"stages" is missing')
+        for stage, name in STAGE_NAMES.items():
+            entry = stages.get(name)
+            if not isinstance(entry, dict):
+                raise ValueError(f"Stage {name} is missing")
+            question = entry.get("question")
+            summary = entry.get("summary", "")
+            choices = entry.get("choices", [])
+            if not isinstance(question, str) or not question:
+                raise ValueError(f"Stage {name} has no question")
+            if not isinstance(summary, str) or (not summary and stage != CONFIRMATION):
+                raise ValueError(f"Stage {name} has no summary")
+            if not isinstance(choices, list) or not all(isinstance(option, str) and option for option in choices):
+                raise ValueError(f"Choices of stage {name} must be a list of non-empty strings")
+            if len(choices) > MAX_CHOICES:
+                raise ValueError(f"Stage {name} has more than {MAX_CHOICES} choices")
+            if not choices and stage != ROUND:
+                raise ValueError(f"Stage {name} has no choices")
+            self.stages[stage] = CompiledStage(stage, version, question, summary, choices)
+        if len(self.stages[CONFIRMATION].choices) != 2:
+            raise ValueError("CONFIRMATION must have exactly two choices, yes and no")
+        extra = set(stages) - set(STAGE_NAMES.values())
+        if extra:
+            raise ValueError(f"Unknown stages: {', '.join(sorted(extra))}")
+
+    @property
+    def first_stage(self) -> int:
+        return ROUND if self.stages[ROUND].choices else JUDGE
+
+    @property
+    def no_feedback(self) -> str:
+        return self.stages[FEEDBACK].choices[0]
+
+    @property
+    def confirm(self) -> str:
+        return self.stages[CONFIRMATION].choices[0]
+
+
+# All form versions loaded since the start. New forms use the current one, forms started earlier
+# keep the version they were started with. The version is a hash of the file, so it survives restarts
+# as long as the file stays the same.
+class FormVersions:
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.current: Optional[FormConfig] = None
+        self.versions: Dict[str, FormConfig] = {}
+        self._mtime: float = 0.0
+
+    def get(self, version: Optional[str]) -> Optional[FormConfig]:
+        return self.versions.get(version)
+
+    # Loads the file if it was changed since the last call, returns True if the current version changed.
+    # Raises OSError or ValueError if the file can't be used, the current version stays then.
+    def reload(self) -> bool:
+        mtime = os.stat(self.filename).st_mtime
+        if self.current is not None and mtime == self._mtime:
+            return False
+        with open(self.filename, "rb") as file:
+            content = file.read()
+        version = hashlib.sha1(content).hexdigest()[:8]
+        if self.current is not None and version == self.current.version:
+            self._mtime = mtime
+            return False
+        config = self.versions.get(version)
+        if config is None:
+            try:
+                data = json.loads(content.decode("utf-8"))
+            except (UnicodeDecodeError, json.JSONDecodeError) as error:
+                raise ValueError(f"{self.filename}: {error}") from error
+            config = FormConfig(data, version)
+            self.versions[version] = config
+        # Only a file that could be used counts as seen, a broken one is read and reported again next time
+        self._mtime = mtime
+        self.current = config
+        return True
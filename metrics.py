@@ -0,0 +1,180 @@
+import bisect
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Counters, gauges and latency histograms rendered in the Prometheus text format.
+# Metrics are changed from the event loop and from writer threads, so every change takes a lock.
+
+LATENCY_BUCKETS: Tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_metrics: List["Metric"] = []
+
+LabelValues = Tuple[str, ...]
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        with _lock:
+            # A module imported twice (as __main__ and by name, e.g. by workers.py) creates its metrics again,
+            # only the newest one is kept
+            _metrics[:] = [metric for metric in _metrics if metric.name != name]
+            _metrics.append(self)
+
+    def _label_str(self, values: LabelValues, extra: str = "") -> str:
+        pairs = [f'{label}="{value}"' for label, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self.samples())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, description, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        with _lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values: str) -> float:
+        return self.values.get(label_values, 0)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._label_str(values)} {value}" for values, value in sorted(self.values.items())]
+
+
+# Value is read from a function when the metrics are rendered
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, function: Callable[[], float]) -> None:
+        super().__init__(name, description)
+        self.function = function
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {self.function()}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+        # label values -> (count per bucket, the last one is +Inf), sum, count
+        self.values: Dict[LabelValues, Tuple[List[int], float, int]] = {}
+
+    def observe(self, seconds: float, *label_values: str) -> None:
+        index = bisect.bisect_left(self.buckets, seconds)
+        with _lock:
+            counts, total, count = self.values.get(label_values) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            counts[index] += 1
+            self.values[label_values] = (counts, total + seconds, count + 1)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for values, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = self._label_str(values, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_str(values)} {total}")
+            lines.append(f"{self.name}_count{self._label_str(values)} {count}")
+        return lines
+
+    def time(self, *label_values: str) -> "_Timer":
+        return _Timer(self, label_values)
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, label_values: LabelValues) -> None:
+        self.histogram = histogram
+        self.label_values = label_values
+        self.started = 0.0
+
+    def __enter__(self) -> "_Timer":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+
+# Wraps an async handler callback, its run time goes into `histogram` labeled with the function name
+def timed(histogram: Histogram) -> Callable:
+    def decorator(callback: Callable) -> Callable:
+        name = callback.__name__
+
+        @functools.wraps(callback)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await callback(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, name)
+        return wrapper
+    return decorator
+
+
+def render() -> str:
+    with _lock:
+        metrics = list(_metrics)
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        data = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+# Serves /metrics from a background thread
+def start_http_server(host: str, port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+# Writes all metrics into the log every `interval` seconds
+def start_log_dump(interval: float, logger: Optional[logging.Logger] = None) -> None:
+    logger = logger or logging.getLogger(__name__)
+
+    def dump() -> None:
+        while True:
+            time.sleep(interval)
+            logger.info("Metrics:\n%s", render())
+
+    threading.Thread(target=dump, name="metrics-log", daemon=True).start()
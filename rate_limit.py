@@ -0,0 +1,254 @@
+import asyncio
+import heapq
+import itertools
+import time
+from datetime import timedelta
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+# Classic token bucket: `rate` tokens per second, at most `capacity` tokens saved up
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1.0) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # Nothing is handed out before this moment (set after a RetryAfter)
+        self.paused_until: float = 0.0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until a token is available, 0 if one was taken
+    def try_acquire(self) -> float:
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    # Waits for a token and takes it. Stops waiting without a token once `cancel` is done, returns
+    # whether a token was taken
+    async def acquire(self, cancel: Optional[asyncio.Future] = None) -> bool:
+        while True:
+            if cancel is not None and cancel.done():
+                return False
+            delay = self.try_acquire()
+            if delay == 0:
+                return True
+            if cancel is None:
+                await asyncio.sleep(delay)
+            else:
+                await asyncio.wait([cancel], timeout=delay)
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def is_idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.paused_until
+
+
+# One token bucket per key (e.g. per chat id), idle buckets are dropped so the dict stays small
+class KeyedTokenBuckets:
+    def __init__(self, rate: float, capacity: float = 1.0, max_keys: int = 10000) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self.buckets: Dict[Hashable, TokenBucket] = {}
+
+    def get(self, key: Hashable) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self.buckets = {k: b for k, b in self.buckets.items() if not b.is_idle()}
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.capacity)
+        return bucket
+
+    async def acquire(self, key: Hashable, cancel: Optional[asyncio.Future] = None) -> bool:
+        return await self.get(key).acquire(cancel)
+
+
+# Lower number is sent first: stopping the button spinner matters more than redrawing the message
+PRIORITIES: Dict[str, int] = {"answerCallbackQuery": 0, "sendMessage": 1, "editMessageText": 2,
+                              "editMessageReplyMarkup": 2}
+DEFAULT_PRIORITY = 1
+EDIT_ENDPOINTS = ("editMessageText", "editMessageReplyMarkup")
+
+queue_wait_seconds = metrics.Histogram("bot_outbound_wait_seconds", "Time requests waited for their turn",
+                                       ["endpoint"])
+outbound_requests = metrics.Counter("bot_outbound_requests_total", "Requests passed to the Bot API",
+                                    ["endpoint", "result"])
+
+
+class _Ticket:
+    __slots__ = ("priority", "seq", "turn", "result", "superseded_by")
+
+    def __init__(self, priority: int, seq: int) -> None:
+        self.priority = priority
+        self.seq = seq
+        # Resolved when the request may be sent, or when a newer edit replaced it
+        self.turn: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.result: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.superseded_by: Optional["_Ticket"] = None
+
+    def __lt__(self, other: "_Ticket") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+# Rate limiter for the application's bot:
+# - every chat gets `chat_rate` requests per second (answerCallbackQuery is not limited per chat),
+# - all requests together get `global_rate` per second, handed out by priority (see PRIORITIES),
+# - RetryAfter pauses the chat (or everything) for the time Telegram asks and the request is retried,
+# - an edit of a message that is still waiting is dropped when a newer edit of the same message comes,
+#   the caller of the dropped edit gets the result of the newer one,
+# - an edit is not sent while another edit of the same message is being sent.
+class OutboundScheduler(BaseRateLimiter):
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 max_retries: int = 3) -> None:
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self.chat_buckets = KeyedTokenBuckets(chat_rate, capacity=chat_burst)
+        self.max_retries = max_retries
+        self._heap: List[_Ticket] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        # (chat id, message id) -> latest edit of that message that was not sent yet
+        self._edits: Dict[Tuple[int, int], _Ticket] = {}
+        # (chat id, message id) -> edit of that message being sent
+        self._sending: Dict[Tuple[int, int], _Ticket] = {}
+        self.waiting = 0
+        self.coalesced = 0
+
+    # Called by every bot that uses the limiter, so it may run more than once
+    async def initialize(self) -> None:
+        if self._dispatcher is None:
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.wait([self._dispatcher])
+            self._dispatcher = None
+
+    async def _dispatch(self) -> None:
+        while True:
+            while self._heap and self._heap[0].turn.done():
+                heapq.heappop(self._heap)
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self.global_bucket.try_acquire()
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            heapq.heappop(self._heap).turn.set_result(None)
+
+    async def _wait_turn(self, ticket: _Ticket) -> None:
+        heapq.heappush(self._heap, ticket)
+        self._wakeup.set()
+        await ticket.turn
+
+    async def process_request(self, callback, args, kwargs, endpoint: str, data: Dict[str, Any],
+                              rate_limit_args: Optional[Any]):
+        chat_id = data.get("chat_id")
+        edit_key = None
+        if endpoint in EDIT_ENDPOINTS and chat_id is not None and data.get("message_id") is not None:
+            edit_key = (chat_id, data["message_id"])
+        ticket = _Ticket(PRIORITIES.get(endpoint, DEFAULT_PRIORITY), next(self._seq))
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            if edit_key is not None:
+                previous = self._edits.get(edit_key)
+                self._edits[edit_key] = ticket
+                if previous is not None:
+                    previous.superseded_by = ticket
+                    if not previous.turn.done():
+                        previous.turn.set_result(None)
+                # Edits of one message must not overtake each other
+                sending = self._sending.get(edit_key)
+                while sending is not None and ticket.superseded_by is None:
+                    await asyncio.wait([sending.result])
+                    sending = self._sending.get(edit_key)
+            if chat_id is not None and endpoint != "answerCallbackQuery" and ticket.superseded_by is None:
+                # A newer edit resolves the turn of the one it replaces, which then stops waiting for the
+                # chat's token, so replaced edits don't use up the chat's budget
+                await self.chat_buckets.acquire(chat_id, ticket.turn)
+            if ticket.superseded_by is None:
+                await self._wait_turn(ticket)
+        finally:
+            self.waiting -= 1
+        queue_wait_seconds.observe(time.monotonic() - started, endpoint)
+
+        try:
+            if ticket.superseded_by is not None:
+                self.coalesced += 1
+                outbound_requests.inc(endpoint, "coalesced")
+                result = await asyncio.shield(ticket.superseded_by.result)
+            else:
+                if edit_key is not None:
+                    del self._edits[edit_key]
+                    self._sending[edit_key] = ticket
+                result = await self._send(callback, args, kwargs, endpoint, chat_id)
+            ticket.result.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            ticket.result.cancel()
+            raise
+        except Exception as error:
+            if not ticket.result.done():
+                ticket.result.set_exception(error)
+                # Nobody may be waiting for it, avoid "exception was never retrieved"
+                ticket.result.exception()
+            raise
+        finally:
+            if edit_key is not None:
+                if self._edits.get(edit_key) is ticket:
+                    del self._edits[edit_key]
+                if self._sending.get(edit_key) is ticket:
+                    del self._sending[edit_key]
+
+    async def _send(self, callback, args, kwargs, endpoint: str, chat_id: Optional[int]):
+        retries = 0
+        while True:
+            try:
+                result = await callback(*args, **kwargs)
+                outbound_requests.inc(endpoint, "ok")
+                return result
+            except RetryAfter as error:
+                outbound_requests.inc(endpoint, "retry_after")
+                retries += 1
+                if retries > self.max_retries:
+                    raise
+                delay = retry_after_seconds(error)
+                if chat_id is not None:
+                    self.chat_buckets.get(chat_id).pause(delay)
+                    await self.chat_buckets.acquire(chat_id)
+                else:
+                    self.global_bucket.pause(delay)
+                await self._wait_turn(_Ticket(PRIORITIES.get(endpoint, DEFAULT_PRIORITY), next(self._seq)))
+
+    # Requests waiting for a per chat or the global token
+    def queue_length(self) -> int:
+        return self.waiting
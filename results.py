@@ -0,0 +1,187 @@
+import csv
+import os
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Column layout of answers_out.csv as written by bot.save_answers:
+# 4 columns about the chat followed by one column per form stage.
+# Lines end in "\n" like the ones older versions wrote without csv, so writers set lineterminator
+HEADER: List[str] = ["Timestamp", "Chat ID", " Chat Username", " Chat Fullname", " Round", " Judge",
+                     " Team Name", " Place", " Analysis Rate", " Comparison Rate", " Feedback Rate",
+                     " Regulations", " Feedback", " Confirmation (Always Yes)"]
+(TIMESTAMP_COL, CHAT_ID_COL, USERNAME_COL, FULLNAME_COL, ROUND_COL, JUDGE_COL, TEAM_COL, PLACE_COL,
+ RATE1_COL, RATE2_COL, RATE3_COL, RATE4_COL, FEEDBACK_COL, CONFIRMATION_COL) = range(len(HEADER))
+RATE_COLS: Tuple[int, ...] = (RATE1_COL, RATE2_COL, RATE3_COL)
+
+# Telegram does not accept longer messages
+MAX_MESSAGE_LENGTH = 4096
+
+
+# Streams the results file once and hands every row to each consumer, returns the number of rows
+def scan_results(filename: str, consumers: Iterable[Callable[[List[str]], None]]) -> int:
+    consumers = list(consumers)
+    rows = 0
+    if not os.path.exists(filename):
+        return rows
+    with open(filename, newline='', encoding="utf-8") as file:
+        for row in csv.reader(file):
+            if len(row) < len(HEADER) or row[TIMESTAMP_COL] == HEADER[TIMESTAMP_COL]:
+                continue
+            rows += 1
+            for consumer in consumers:
+                consumer(row)
+    return rows
+
+
+# One answer per chat for the same round, judge and team
+SubmissionKey = Tuple[str, str, str, str]
+
+
+def submission_key(row: List[str]) -> SubmissionKey:
+    return row[CHAT_ID_COL], row[ROUND_COL], row[JUDGE_COL], row[TEAM_COL]
+
+
+# The answer kept for every submission key, filled by streaming the results file at startup
+class SubmissionIndex:
+    def __init__(self) -> None:
+        self.rows: Dict[SubmissionKey, List[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def get(self, row: List[str]) -> Optional[List[str]]:
+        return self.rows.get(submission_key(row))
+
+    # Returns the row that was replaced, if any
+    def put(self, row: List[str]) -> Optional[List[str]]:
+        key = submission_key(row)
+        previous = self.rows.get(key)
+        self.rows[key] = row
+        return previous
+
+
+# Rewrites the results file keeping one row per submission key, the last one if `latest` or else the first.
+# The file is streamed twice and only the keys are kept in memory. Rows that are not answers
+# (the header, broken lines) are kept as they are. Returns (rows kept, rows dropped).
+def compact_results(filename: str, latest: bool = True) -> Tuple[int, int]:
+    winners: Dict[SubmissionKey, int] = {}
+    if not os.path.exists(filename):
+        return 0, 0
+    with open(filename, newline='', encoding="utf-8") as file:
+        for line, row in enumerate(csv.reader(file)):
+            if len(row) < len(HEADER) or row[TIMESTAMP_COL] == HEADER[TIMESTAMP_COL]:
+                continue
+            key = submission_key(row)
+            if latest or key not in winners:
+                winners[key] = line
+
+    kept = dropped = 0
+    tmp_filename = filename + ".tmp"
+    with open(filename, newline='', encoding="utf-8") as file, \
+            open(tmp_filename, "w", newline='', encoding="utf-8") as out:
+        writer = csv.writer(out, lineterminator="\n")
+        for line, row in enumerate(csv.reader(file)):
+            if len(row) >= len(HEADER) and row[TIMESTAMP_COL] != HEADER[TIMESTAMP_COL]:
+                if winners[submission_key(row)] != line:
+                    dropped += 1
+                    continue
+                kept += 1
+            writer.writerow(row)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_filename, filename)
+    return kept, dropped
+
+
+# Running totals for one judge / round / team
+class Aggregate:
+    __slots__ = ("count", "wins", "losses", "compliant", "rate_sums", "rate_counts", "distributions")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.wins = 0
+        self.losses = 0
+        self.compliant = 0
+        self.rate_sums = [0] * len(RATE_COLS)
+        self.rate_counts = [0] * len(RATE_COLS)
+        # value -> number of answers, for every rate
+        self.distributions: List[Dict[int, int]] = [{} for _ in RATE_COLS]
+
+    # sign -1 takes a row added before out again, n adds n equal rows
+    def add(self, row: List[str], win_value: str, compliant_value: str, sign: int = 1) -> None:
+        self.count += sign
+        if row[PLACE_COL] == win_value:
+            self.wins += sign
+        elif row[PLACE_COL]:
+            self.losses += sign
+        if row[RATE4_COL] == compliant_value:
+            self.compliant += sign
+        for i, col in enumerate(RATE_COLS):
+            if row[col].isdigit():
+                value = int(row[col])
+                self.rate_sums[i] += sign * value
+                self.rate_counts[i] += sign
+                count = self.distributions[i].get(value, 0) + sign
+                if count:
+                    self.distributions[i][value] = count
+                else:
+                    del self.distributions[i][value]
+
+    # Adds the totals of another aggregate, e.g. one counted over another part of the file
+    def merge(self, other: "Aggregate") -> None:
+        self.count += other.count
+        self.wins += other.wins
+        self.losses += other.losses
+        self.compliant += other.compliant
+        for i in range(len(RATE_COLS)):
+            self.rate_sums[i] += other.rate_sums[i]
+            self.rate_counts[i] += other.rate_counts[i]
+            for value, count in other.distributions[i].items():
+                self.distributions[i][value] = self.distributions[i].get(value, 0) + count
+
+    def mean(self, i: int) -> float:
+        return self.rate_sums[i] / self.rate_counts[i] if self.rate_counts[i] else 0.0
+
+    def to_str(self) -> str:
+        means = " / ".join(f"{self.mean(i):.2f}" for i in range(len(RATE_COLS)))
+        distributions = " ".join(
+            "[" + " ".join(f"{value}:{count}" for value, count in sorted(distribution.items())) + "]"
+            for distribution in self.distributions)
+        compliant = self.compliant * 100 // self.count if self.count else 0
+        return (f"{self.count} отз., ср. {means}, {distributions}, "
+                f"соблюдено {compliant}%, W/L {self.wins}/{self.losses}")
+
+
+# Per judge, per round and per team aggregates, updated as answers are saved
+class AnswerStats:
+    GROUPS: Dict[str, int] = {"judge": JUDGE_COL, "round": ROUND_COL, "team": TEAM_COL}
+
+    def __init__(self, win_value: str, compliant_value: str) -> None:
+        self.win_value = win_value
+        self.compliant_value = compliant_value
+        self.total = Aggregate()
+        self.groups: Dict[str, Dict[str, Aggregate]] = {group: {} for group in self.GROUPS}
+
+    def add(self, row: List[str]) -> None:
+        self.total.add(row, self.win_value, self.compliant_value)
+        for group, col in self.GROUPS.items():
+            aggregates = self.groups[group]
+            if row[col] not in aggregates:
+                aggregates[row[col]] = Aggregate()
+            aggregates[row[col]].add(row, self.win_value, self.compliant_value)
+
+    def remove(self, row: List[str]) -> None:
+        self.total.add(row, self.win_value, self.compliant_value, -1)
+        for group, col in self.GROUPS.items():
+            aggregates = self.groups[group]
+            aggregates[row[col]].add(row, self.win_value, self.compliant_value, -1)
+            if aggregates[row[col]].count == 0:
+                del aggregates[row[col]]
+
+    def to_str(self, group: str = "judge") -> str:
+        lines = [f"Всего: {self.total.to_str()}", ""]
+        for name, aggregate in sorted(self.groups[group].items()):
+            lines.append(f"{name}: {aggregate.to_str()}")
+        text = "\n".join(lines)
+        if len(text) > MAX_MESSAGE_LENGTH:
+            text = text[:MAX_MESSAGE_LENGTH - 3] + "..."
+        return text
@@ -0,0 +1,113 @@
+import functools
+import re
+from typing import Dict, FrozenSet, List, Set, Tuple
+
+from results import (FEEDBACK_COL, JUDGE_COL, MAX_MESSAGE_LENGTH, ROUND_COL, TEAM_COL, TIMESTAMP_COL,
+                     SubmissionKey, submission_key)
+
+# Inverted index over the free-text comments (FEEDBACK column) of the answers.
+# Words are case folded, "ё" is read as "е" and common Russian and English endings are cut off,
+# so "Опоздал", "опоздала" and "опоздали" all find each other. A search returns the comments
+# containing every word of the query, newest first.
+
+WORD = re.compile(r"\w+")
+# Longest first, an ending is only cut if at least MIN_STEM letters stay
+ENDINGS: Tuple[str, ...] = tuple(sorted((
+    "иями", "ями", "ами", "ией", "иям", "ием", "иях", "ого", "его", "ому", "ему", "ыми", "ими", "ешь", "ете", "ишь",
+    "ите", "ала", "яла", "ила", "ыла", "али", "яли", "или", "ыли", "ало", "яло", "ило", "ыло", "ать", "ять", "ить",
+    "еть", "уть", "ают", "яют", "уют", "ует", "ах", "ях", "ам", "ям", "ом", "ем", "ой", "ей", "ый", "ий", "ая", "яя",
+    "ое", "ее", "ые", "ие", "ую", "юю", "ым", "им", "ал", "ял", "ил", "ыл", "ла", "ли", "ло", "ть", "ет", "ит", "ут",
+    "ют", "ат", "ят", "ов", "ев", "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+    "ing", "ed", "es", "s"), key=len, reverse=True))
+MIN_STEM = 3
+
+PAGE_SIZE = 5
+# Longer comments are cut in the search results
+MAX_COMMENT_LENGTH = 500
+
+
+# Ending length -> endings, checked longest first. Only one ending of a length can match a word,
+# so a word is looked up once per length instead of comparing it with every ending
+ENDINGS_BY_LENGTH: Tuple[Tuple[int, FrozenSet[str]], ...] = tuple(
+    (length, frozenset(ending for ending in ENDINGS if len(ending) == length))
+    for length in sorted({len(ending) for ending in ENDINGS}, reverse=True))
+
+
+# Comments use a small vocabulary, so most words were stemmed before
+@functools.lru_cache(maxsize=100000)
+def stem(word: str) -> str:
+    for length, endings in ENDINGS_BY_LENGTH:
+        if len(word) - length >= MIN_STEM and word[-length:] in endings:
+            return word[:-length]
+    return word
+
+
+def terms(text: str) -> List[str]:
+    return [stem(word) for word in WORD.findall(text.casefold().replace("ё", "е"))]
+
+
+# timestamp, round, judge, team, comment
+Comment = Tuple[str, str, str, str, str]
+
+
+class CommentIndex:
+    def __init__(self) -> None:
+        # Document ids grow, so a higher id is a newer comment
+        self.comments: Dict[int, Comment] = {}
+        self.postings: Dict[str, Set[int]] = {}
+        # Latest comment of every submission key (see results.SubmissionIndex)
+        self.docs: Dict[SubmissionKey, int] = {}
+        self._next_id = 0
+
+    def __len__(self) -> int:
+        return len(self.comments)
+
+    # Adds the comment of an answer row, replacing the comment of an earlier answer with the same key
+    def add(self, row: List[str]) -> None:
+        self.remove(row)
+        text = row[FEEDBACK_COL]
+        if not text.strip():
+            return
+        doc = self._next_id
+        self._next_id += 1
+        self.comments[doc] = (row[TIMESTAMP_COL], row[ROUND_COL], row[JUDGE_COL], row[TEAM_COL], text)
+        self.docs[submission_key(row)] = doc
+        for term in set(terms(text)):
+            self.postings.setdefault(term, set()).add(doc)
+
+    def remove(self, row: List[str]) -> None:
+        doc = self.docs.pop(submission_key(row), None)
+        if doc is None:
+            return
+        for term in set(terms(self.comments.pop(doc)[4])):
+            postings = self.postings[term]
+            postings.discard(doc)
+            if not postings:
+                del self.postings[term]
+
+    # Comments containing all words of the query, newest first
+    def search(self, query: str) -> List[Comment]:
+        query_terms = set(terms(query))
+        if not query_terms:
+            return []
+        postings = sorted((self.postings.get(term, set()) for term in query_terms), key=len)
+        docs = set(postings[0]).intersection(*postings[1:])
+        return [self.comments[doc] for doc in sorted(docs, reverse=True)]
+
+
+def pages(matches: List[Comment]) -> int:
+    return max(1, (len(matches) + PAGE_SIZE - 1) // PAGE_SIZE)
+
+
+def render_page(query: str, matches: List[Comment], page: int) -> str:
+    if not matches:
+        return f"По запросу «{query}» ничего не найдено"
+    lines = [f"«{query}»: {len(matches)} отз., стр. {page + 1}/{pages(matches)}"]
+    for timestamp, round_, judge, team, text in matches[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]:
+        if len(text) > MAX_COMMENT_LENGTH:
+            text = text[:MAX_COMMENT_LENGTH - 3] + "..."
+        lines.append(f"\nРаунд {round_} | {judge} | {team} | {timestamp}\n{text}")
+    text = "\n".join(lines)
+    if len(text) > MAX_MESSAGE_LENGTH:
+        text = text[:MAX_MESSAGE_LENGTH - 3] + "..."
+    return text
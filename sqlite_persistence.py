@@ -0,0 +1,294 @@
+import asyncio
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import metrics
+
+# Same shapes as telegram.ext uses for callback data and conversations
+CDCData = Tuple[List[Tuple[str, float, Dict[str, Any]]], Dict[str, str]]
+ConversationKey = Tuple[int, ...]
+ConversationDict = Dict[ConversationKey, object]
+
+USER, CHAT, BOT = "user", "chat", "bot"
+
+commit_seconds = metrics.Histogram("bot_persistence_commit_seconds", "Time to commit one persistence run")
+rows_written = metrics.Counter("bot_persistence_rows_written_total", "User, chat and bot data rows written")
+commit_errors = metrics.Counter("bot_persistence_commit_errors_total", "Failed commits, retried later", ["error"])
+logger = logging.getLogger(__name__)
+
+# Commits run on the event loop, so they wait this long for another process (see workers.py)
+# holding the write lock, and are retried after COMMIT_RETRY_SECONDS instead of blocking the loop
+BUSY_TIMEOUT_MS = 50
+COMMIT_RETRY_SECONDS = 1.0
+# The last commit at shutdown waits longer, nothing else runs then
+FLUSH_BUSY_TIMEOUT_MS = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS data (kind TEXT NOT NULL, id INTEGER NOT NULL, value BLOB NOT NULL, PRIMARY KEY (kind, id));
+CREATE TABLE IF NOT EXISTS conversations (name TEXT NOT NULL, key TEXT NOT NULL, state BLOB NOT NULL, PRIMARY KEY (name, key));
+CREATE TABLE IF NOT EXISTS callback_keyboards (uuid TEXT PRIMARY KEY, created REAL NOT NULL, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS callback_queries (query_id TEXT PRIMARY KEY, keyboard_uuid TEXT NOT NULL);
+"""
+
+
+def loop_running() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+# Persistence in a SQLite database (WAL mode) with one row per user / chat.
+# Only rows of users that changed are written, and a user's row is read when their first update arrives
+# (refresh_user_data) instead of loading everybody at startup. Only users for which
+# preload_user_data(user id, data) is true are loaded at startup.
+# Writes made during one persistence run are committed together in one transaction.
+class SqlitePersistence(BasePersistence):
+    def __init__(self, filepath: str, store_data: Optional[PersistenceInput] = None, update_interval: float = 60,
+                 callback_data_ttl: float = 7 * 24 * 60 * 60,
+                 preload_user_data: Optional[Callable[[int, Any], bool]] = None) -> None:
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.filepath = filepath
+        self.callback_data_ttl = callback_data_ttl
+        self.preload_user_data = preload_user_data
+        self.connection = sqlite3.connect(filepath, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        self.connection.executescript(SCHEMA)
+        # Users / chats whose row has already been read into the application
+        self._loaded: Dict[str, Set[int]] = {USER: set(), CHAT: set()}
+        # (kind, id) -> pickled value, None means delete
+        self._dirty: Dict[Tuple[str, int], Optional[bytes]] = {}
+        self._dirty_conversations: Dict[Tuple[str, str], bytes] = {}
+        self._callback_uuids: Set[str] = set()
+        self._callback_dirty: Optional[CDCData] = None
+        self._commit_scheduled = False
+        self._closed = False
+        self.last_commit_seconds: float = 0.0
+
+    def _read(self, kind: str, key: int) -> Optional[Any]:
+        row = self.connection.execute("SELECT value FROM data WHERE kind = ? AND id = ?", (kind, key)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def _mark_dirty(self, kind: str, key: int, value: Optional[Any]) -> None:
+        self._put(kind, key, value)
+        self._schedule_commit()
+
+    def _put(self, kind: str, key: int, value: Optional[Any]) -> None:
+        self._dirty[(kind, key)] = None if value is None else pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    # Application.update_persistence calls update_* for every changed user at once,
+    # committing on the next loop iteration puts all of them into one transaction
+    def _schedule_commit(self, delay: float = 0) -> None:
+        if self._commit_scheduled:
+            return
+        self._commit_scheduled = True
+        if loop_running():
+            asyncio.get_running_loop().call_later(delay, self.commit)
+        else:
+            self.commit()
+
+    # Writes everything changed since the last commit. If the database is locked by another process
+    # or the write fails, the changes stay pending and the commit is tried again later
+    def commit(self) -> None:
+        self._commit_scheduled = False
+        if self._closed:
+            return
+        try:
+            self._write()
+        except sqlite3.Error as error:
+            commit_errors.inc(type(error).__name__)
+            if not loop_running():
+                raise
+            logger.warning("Persistence not committed, retrying in %.1f s: %s", COMMIT_RETRY_SECONDS, error)
+            self._schedule_commit(COMMIT_RETRY_SECONDS)
+
+    # The pending changes are only dropped once the transaction went through
+    def _write(self) -> None:
+        if not self._dirty and not self._dirty_conversations and self._callback_dirty is None:
+            return
+        started = time.perf_counter()
+        callback_uuids = self._callback_uuids
+        with self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO data (kind, id, value) VALUES (?, ?, ?)",
+                [(kind, key, value) for (kind, key), value in self._dirty.items() if value is not None])
+            self.connection.executemany(
+                "DELETE FROM data WHERE kind = ? AND id = ?",
+                [(kind, key) for (kind, key), value in self._dirty.items() if value is None])
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                [(name, key, state) for (name, key), state in self._dirty_conversations.items()])
+            if self._callback_dirty is not None:
+                callback_uuids = self._write_callback_data(self._callback_dirty)
+        rows = len(self._dirty)
+        self._dirty = {}
+        self._dirty_conversations = {}
+        self._callback_dirty = None
+        self._callback_uuids = callback_uuids
+        self.last_commit_seconds = time.perf_counter() - started
+        commit_seconds.observe(self.last_commit_seconds)
+        rows_written.inc(amount=rows)
+
+    # User and chat data are loaded lazily in refresh_*_data, apart from the users picked by preload_user_data
+    async def get_user_data(self) -> Dict[int, Any]:
+        users: Dict[int, Any] = {}
+        if self.preload_user_data is None:
+            return users
+        for user_id, value in self.connection.execute("SELECT id, value FROM data WHERE kind = ?", (USER,)):
+            data = pickle.loads(value)
+            if self.preload_user_data(user_id, data):
+                users[user_id] = data
+                self._loaded[USER].add(user_id)
+        return users
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_bot_data(self) -> Any:
+        bot_data = self._read(BOT, 0)
+        return bot_data if bot_data is not None else {}
+
+    async def refresh_user_data(self, user_id: int, user_data: Any) -> None:
+        self._refresh(USER, user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        self._refresh(CHAT, chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data: Any) -> None:
+        pass
+
+    def _refresh(self, kind: str, key: int, data: Dict) -> None:
+        if key in self._loaded[kind]:
+            return
+        self._loaded[kind].add(key)
+        stored = self._read(kind, key)
+        if stored:
+            # Anything set before the row was read (normally nothing) wins
+            data.update({k: v for k, v in stored.items() if k not in data})
+
+    async def update_user_data(self, user_id: int, data: Any) -> None:
+        self._loaded[USER].add(user_id)
+        self._mark_dirty(USER, user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: Any) -> None:
+        self._loaded[CHAT].add(chat_id)
+        self._mark_dirty(CHAT, chat_id, data)
+
+    async def update_bot_data(self, data: Any) -> None:
+        self._mark_dirty(BOT, 0, data)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._mark_dirty(USER, user_id, None)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._mark_dirty(CHAT, chat_id, None)
+
+    async def get_conversations(self, name: str) -> ConversationDict:
+        rows = self.connection.execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name: str, key: ConversationKey, new_state: Optional[object]) -> None:
+        self._dirty_conversations[(name, json.dumps(key))] = pickle.dumps(new_state, pickle.HIGHEST_PROTOCOL)
+        self._schedule_commit()
+
+    # Callback data: one row per keyboard, keyboards older than callback_data_ttl are dropped
+    async def get_callback_data(self) -> Optional[CDCData]:
+        expired = time.time() - self.callback_data_ttl
+        with self.connection:
+            self.connection.execute("DELETE FROM callback_keyboards WHERE created < ?", (expired,))
+            self.connection.execute(
+                "DELETE FROM callback_queries WHERE keyboard_uuid NOT IN (SELECT uuid FROM callback_keyboards)")
+        keyboards = [(uuid, created, pickle.loads(data)) for uuid, created, data in
+                     self.connection.execute("SELECT uuid, created, data FROM callback_keyboards ORDER BY created")]
+        queries = dict(self.connection.execute("SELECT query_id, keyboard_uuid FROM callback_queries"))
+        self._callback_uuids = {uuid for uuid, _, _ in keyboards}
+        if not keyboards and not queries:
+            return None
+        return keyboards, queries
+
+    async def update_callback_data(self, data: CDCData) -> None:
+        self._callback_dirty = data
+        self._schedule_commit()
+
+    # Returns the keyboards stored after the transaction
+    def _write_callback_data(self, data: CDCData) -> Set[str]:
+        keyboards, queries = data
+        expired = time.time() - self.callback_data_ttl
+        current = {uuid: (created, buttons) for uuid, created, buttons in keyboards if created >= expired}
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO callback_keyboards (uuid, created, data) VALUES (?, ?, ?)",
+            [(uuid, created, pickle.dumps(buttons, pickle.HIGHEST_PROTOCOL))
+             for uuid, (created, buttons) in current.items() if uuid not in self._callback_uuids])
+        self.connection.executemany("DELETE FROM callback_keyboards WHERE uuid = ?",
+                                    [(uuid,) for uuid in self._callback_uuids - current.keys()])
+        self.connection.execute("DELETE FROM callback_queries")
+        self.connection.executemany("INSERT INTO callback_queries (query_id, keyboard_uuid) VALUES (?, ?)",
+                                    [(query_id, uuid) for query_id, uuid in queries.items() if uuid in current])
+        return set(current)
+
+    async def flush(self) -> None:
+        self.connection.execute(f"PRAGMA busy_timeout={FLUSH_BUSY_TIMEOUT_MS}")
+        try:
+            self._write()
+        finally:
+            self._closed = True
+            self.connection.close()
+
+
+class _MigrationUnpickler(pickle.Unpickler):
+    # Bot instances are stored as persistent ids by PicklePersistence, they are not needed here
+    def persistent_load(self, pid: str) -> None:
+        return None
+
+
+# One-shot copy of a single file PicklePersistence into the database, written in one transaction.
+# The database is built under a temporary name and only appears at `filepath` when it is complete,
+# so a migration that failed runs again at the next start
+def migrate_pickle(pickle_filepath: str, filepath: str) -> None:
+    started = time.perf_counter()
+    with open(pickle_filepath, "rb") as file:
+        data = _MigrationUnpickler(file).load()
+    users = data.get("user_data") or {}
+    tmp_filepath = filepath + ".tmp"
+    remove_database(tmp_filepath)
+    persistence = SqlitePersistence(tmp_filepath)
+    try:
+        for user_id, user_data in users.items():
+            persistence._put(USER, user_id, user_data)
+        for chat_id, chat_data in (data.get("chat_data") or {}).items():
+            persistence._put(CHAT, chat_id, chat_data)
+        if data.get("bot_data"):
+            persistence._put(BOT, 0, data["bot_data"])
+        for name, conversations in (data.get("conversations") or {}).items():
+            for key, state in conversations.items():
+                persistence._dirty_conversations[(name, json.dumps(key))] = pickle.dumps(state,
+                                                                                         pickle.HIGHEST_PROTOCOL)
+        if data.get("callback_data"):
+            persistence._callback_dirty = data["callback_data"]
+        persistence._write()
+    except BaseException:
+        persistence.connection.close()
+        remove_database(tmp_filepath)
+        raise
+    persistence.connection.close()
+    os.replace(tmp_filepath, filepath)
+    print(f"Migrated {len(users)} users from {pickle_filepath} to {filepath} "
+          f"in {time.perf_counter() - started:.2f} s")
+
+
+# The database file and the WAL files next to it
+def remove_database(filepath: str) -> None:
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(filepath + suffix):
+            os.remove(filepath + suffix)
@@ -0,0 +1,28 @@
+import asyncio
+import os
+
+import broadcast
+from fake_bot_api import FakeRequest
+
+
+def test_same_text_can_be_broadcast_again(tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    fake = FakeRequest()
+    monkeypatch.setattr(broadcast, "HTTPXRequest", lambda connection_pool_size: fake)
+    for _ in range(2):
+        statuses = asyncio.run(broadcast.broadcast("1:token", "https://api.telegram.org/bot", [1, 2], "Hi", 2))
+        assert statuses == {"ok": 2}
+        assert not os.path.exists(broadcast.checkpoint_filename("Hi"))
+    assert fake.calls["sendMessage"] == 4
+
+
+def test_checkpoint_kept_for_retries(tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(broadcast, "HTTPXRequest", lambda connection_pool_size: FakeRequest())
+
+    async def send_one(self, chat_id: int) -> str:
+        return "error" if chat_id == 2 else "ok"
+
+    monkeypatch.setattr(broadcast.Broadcast, "send_one", send_one)
+    asyncio.run(broadcast.broadcast("1:token", "https://api.telegram.org/bot", [1, 2], "Hi", 2))
+    assert broadcast.load_checkpoint(broadcast.checkpoint_filename("Hi")) == {1}
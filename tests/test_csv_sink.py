@@ -0,0 +1,28 @@
+import csv
+import time
+
+import bot
+
+
+def test_sink_keeps_rows_while_the_file_cannot_be_written(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(bot, "SINK_RETRY_SECONDS", 0.05)
+    directory = tmp_path / "missing"
+    filename = str(directory / "answers.csv")
+    sink = bot.CsvAppendSink(filename, ["a", "b"], 0.01, fsync=True)
+    errors = bot.sink_errors.get(filename)
+    sink.start()
+    sink.put(["1", "2"])
+    time.sleep(0.2)
+    assert not sink.healthy
+    assert bot.sink_errors.get(filename) > errors
+    assert sink.pending_rows == 1
+
+    directory.mkdir()
+    sink.put(["3", "4"])
+    time.sleep(0.2)
+    assert sink.healthy
+    sink.close()
+    with open(filename, newline='', encoding="utf-8") as file:
+        assert list(csv.reader(file)) == [["a", "b"], ["1", "2"], ["3", "4"]]
+    with open(filename, "rb") as file:
+        assert file.read() == b"a,b\n1,2\n3,4\n"
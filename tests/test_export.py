@@ -0,0 +1,51 @@
+import csv
+import mmap
+import os
+import random
+
+import export
+import results
+
+WIN, COMPLIANT = "1", "ДА"
+
+
+def write_answers(filename: str, rows: int) -> None:
+    random.seed(3)
+    comments = ["", "коротко", 'в "кавычках", с запятой', "две\nстроки", '"\n"\n""', "конец строки\n"]
+    with open(filename, "w", newline='', encoding="utf-8") as file:
+        writer = csv.writer(file, lineterminator="\n")
+        writer.writerow(results.HEADER)
+        for i in range(rows):
+            writer.writerow([f"2026-01-01 12:{i % 60:02d}:00", str(i), "", "", str(i % 3), f"Judge {i % 4}",
+                             f"Team {i % 5}", random.choice([WIN, "2"]), *(str(random.randint(1, 5)) for _ in range(3)),
+                             random.choice([COMPLIANT, "НЕТ"]), random.choice(comments), "ДА"])
+
+
+def test_chunks_end_at_row_boundaries(tmp_path) -> None:
+    filename = str(tmp_path / "answers.csv")
+    write_answers(filename, 200)
+    with open(filename, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        bounds = export.chunk_bounds(data, 37)
+    assert bounds[0][0] == 0 and bounds[-1][1] == os.path.getsize(filename)
+    assert all(end == start for (_, end), (start, _) in zip(bounds, bounds[1:]))
+    assert sum(len(list(export.read_chunk(filename, start, end))) for start, end in bounds) == 200
+
+
+def test_chunked_export_equals_one_pass(tmp_path) -> None:
+    filename = str(tmp_path / "answers.csv")
+    write_answers(filename, 200)
+    stats = results.AnswerStats(WIN, COMPLIANT)
+    comments = []
+    assert results.scan_results(filename, [stats.add, lambda row: comments.append(row[results.FEEDBACK_COL])]) == 200
+
+    expected = str(tmp_path / "expected.txt")
+    export.write_summary(expected, stats.total, stats.groups["judge"], stats.groups["round"])
+    out = str(tmp_path / "reports")
+    assert export.export_results(filename, out, WIN, COMPLIANT, chunk_size=37, progress=False) == (200, 4)
+    with open(expected, encoding="utf-8") as file, open(os.path.join(out, "summary.txt"), encoding="utf-8") as summary:
+        assert summary.read() == file.read()
+    exported = 0
+    for judge in os.listdir(os.path.join(out, "judges")):
+        with open(os.path.join(out, "judges", judge), encoding="utf-8") as file:
+            exported += sum(line.startswith("Раунд ") and " | " in line for line in file)
+    assert exported == sum(1 for comment in comments if comment.strip())
@@ -0,0 +1,29 @@
+import os
+import shutil
+
+import pytest
+
+from form_config import FormVersions
+
+FORM_FILENAME = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "form.json")
+
+
+def test_broken_form_keeps_failing_until_fixed(tmp_path) -> None:
+    filename = str(tmp_path / "form.json")
+    shutil.copy(FORM_FILENAME, filename)
+    versions = FormVersions(filename)
+    assert versions.reload()
+    version = versions.current.version
+
+    with open(filename, "a", encoding="utf-8") as file:
+        file.write("{")
+    os.utime(filename, (1, 1))
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            versions.reload()
+    assert versions.current.version == version
+
+    shutil.copy(FORM_FILENAME, filename)
+    os.utime(filename, (2, 2))
+    assert not versions.reload()
+    assert not versions.reload()
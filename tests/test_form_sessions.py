@@ -0,0 +1,103 @@
+import asyncio
+import os
+import shutil
+import time
+from types import SimpleNamespace
+from typing import Dict, List
+
+from telegram import Update
+
+import bot
+from bench_load import callback_update, message_update
+from fake_bot_api import FakeRequest
+from form_config import encode_callback_data
+from sqlite_persistence import USER, SqlitePersistence
+
+FORM_FILENAME = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "form.json")
+
+
+class FakeApplication:
+    def __init__(self, users: List[int]) -> None:
+        self.user_data: Dict[int, Dict] = {user_id: {"form": bot.new_form(bot.ROUND, "v", "")} for user_id in users}
+        self.marked: List[int] = []
+
+    def mark_data_for_update_persistence(self, user_ids: int) -> None:
+        self.marked.append(user_ids)
+
+
+def test_sweep_removes_expired_forms() -> None:
+    application = FakeApplication([1, 2])
+    sessions = bot.FormSessions(ttl=60, max_forms=10)
+    for user_id in (1, 2):
+        sessions.touch(application, user_id, application.user_data[user_id]["form"])
+    sessions.last_active[1] = time.time() - 61
+    asyncio.run(sessions.sweep(SimpleNamespace(application=application)))
+    assert "form" not in application.user_data[1]
+    assert "form" in application.user_data[2]
+    assert list(sessions.last_active) == [2]
+    assert application.marked == [1]
+
+
+def test_least_recently_used_form_is_removed() -> None:
+    application = FakeApplication([1, 2, 3])
+    sessions = bot.FormSessions(ttl=60, max_forms=2)
+    for user_id in (1, 2, 1, 3):
+        sessions.touch(application, user_id, application.user_data[user_id]["form"])
+    assert list(sessions.last_active) == [1, 3]
+    assert "form" not in application.user_data[2]
+
+
+# Two runs of the bot on the same persistence, forms of the first run expire during the second one
+def test_forms_saved_before_a_restart_expire(tmp_path, monkeypatch) -> None:
+    monkeypatch.chdir(tmp_path)
+    shutil.copy(FORM_FILENAME, "form.json")
+    monkeypatch.setattr(bot, "tenants", bot.build_tenants())
+    assert not bot.reload_forms()
+    tenant = bot.tenants[""]
+    tenant.start()
+    texts: List[str] = []
+
+    def application() -> bot.Application:
+        fake = FakeRequest()
+        do_request = fake.do_request
+
+        async def record(url, method, request_data=None, **kwargs):
+            if request_data is not None and "text" in request_data.parameters:
+                texts.append(request_data.parameters["text"])
+            return await do_request(url, method, request_data, **kwargs)
+
+        fake.do_request = record
+        return bot.build_application(lambda: fake)
+
+    async def first_run() -> Dict[int, int]:
+        app = application()
+        async with app:
+            for user_id in (1, 2):
+                await app.process_update(Update.de_json(message_update(user_id, "/start"), app.bot))
+            message_ids = {user_id: app.user_data[user_id]["form"]["message_id"] for user_id in (1, 2)}
+        return message_ids
+
+    async def second_run(message_ids: Dict[int, int]) -> None:
+        app = application()
+        async with app:
+            await bot.post_init(app)
+            assert set(tenant.form_sessions.last_active) == {1, 2}
+            time.sleep(0.1)
+            # User 2 comes back and presses a button of the expired form
+            config = tenant.form_versions.current
+            data = encode_callback_data(config.first_stage, 0, config.version)
+            await app.process_update(Update.de_json(callback_update(2, data, message_ids[2]), app.bot))
+            assert texts[-1].startswith("Форма устарела")
+            # User 1 never comes back
+            await tenant.form_sessions.sweep(SimpleNamespace(application=app))
+            assert "form" not in app.user_data[1]
+
+    try:
+        message_ids = asyncio.run(first_run())
+        tenant.form_sessions = bot.FormSessions(ttl=0.05, max_forms=10)
+        asyncio.run(second_run(message_ids))
+    finally:
+        tenant.close()
+    persistence = SqlitePersistence(bot.persistence_filename)
+    for user_id in (1, 2):
+        assert "form" not in persistence._read(USER, user_id)
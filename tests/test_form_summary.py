@@ -0,0 +1,35 @@
+import os
+
+import bot
+from form_config import CONFIRMATION, FEEDBACK
+
+DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_summary_follows_the_answers(monkeypatch) -> None:
+    tenant = bot.Tenant("", DIRECTORY)
+    monkeypatch.setattr(bot, "tenants", {"": tenant})
+    assert tenant.reload_form() is None
+    config = tenant.form_versions.current
+    form = bot.new_form(config.first_stage, config.version, "")
+
+    def check() -> None:
+        assert bot.form_summary(form) == bot.answers_to_str(form["answers"], config)
+
+    check()
+    for stage in range(config.first_stage, CONFIRMATION):
+        bot.set_answer(form, stage, "Хороший судья" if stage == FEEDBACK else config.stages[stage].choices[-1])
+        check()
+    # The comment is corrected at the confirmation
+    bot.set_answer(form, FEEDBACK, "Поправка")
+    assert form["summary"] is None
+    check()
+    assert "Поправка" in form["summary"] and "Хороший судья" not in form["summary"]
+    bot.set_answer(form, CONFIRMATION, config.confirm)
+    check()
+
+    # Forms saved before the summary was kept
+    del form["summary"]
+    check()
+    bot.set_answer(form, FEEDBACK, "Ещё раз")
+    check()
@@ -0,0 +1,66 @@
+import asyncio
+import time
+from typing import List
+
+from rate_limit import OutboundScheduler
+
+
+def test_edits_of_one_message_do_not_overlap() -> None:
+    async def run() -> List[str]:
+        scheduler = OutboundScheduler(global_rate=1000, chat_rate=1000, chat_burst=1000)
+        await scheduler.initialize()
+        events = []
+
+        async def edit(text: str) -> str:
+            events.append(f"start {text}")
+            await asyncio.sleep(0.1)
+            events.append(f"end {text}")
+            return text
+
+        def request(text: str) -> asyncio.Task:
+            return asyncio.create_task(scheduler.process_request(
+                edit, (text,), {}, "editMessageText", {"chat_id": 1, "message_id": 2, "text": text}, None))
+
+        first = request("A")
+        await asyncio.sleep(0.01)
+        # B waits for A and is replaced by C before A is done
+        second = request("B")
+        await asyncio.sleep(0)
+        third = request("C")
+        results = await asyncio.gather(first, second, third)
+        await scheduler.shutdown()
+        assert results == ["A", "C", "C"]
+        return events
+
+    assert asyncio.run(run()) == ["start A", "end A", "start C", "end C"]
+
+
+def test_replaced_edits_do_not_use_chat_tokens() -> None:
+    async def run() -> None:
+        scheduler = OutboundScheduler(global_rate=1000, chat_rate=1, chat_burst=1)
+        await scheduler.initialize()
+        sent = []
+
+        async def edit(text: str) -> str:
+            sent.append(text)
+            return text
+
+        def request(text: str) -> asyncio.Task:
+            return asyncio.create_task(scheduler.process_request(
+                edit, (text,), {}, "editMessageText", {"chat_id": 1, "message_id": 2, "text": text}, None))
+
+        await request("E1")
+        started = time.monotonic()
+        tasks = []
+        for i in range(2, 12):
+            tasks.append(request(f"E{i}"))
+            await asyncio.sleep(0.01)
+        results = await asyncio.gather(*tasks)
+        elapsed = time.monotonic() - started
+        await scheduler.shutdown()
+        assert results == ["E11"] * 10
+        assert sent == ["E1", "E11"]
+        # One token period after E1, not one per replaced edit
+        assert elapsed < 1.5
+
+    asyncio.run(run())
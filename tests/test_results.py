@@ -0,0 +1,36 @@
+import csv
+from typing import List
+
+import results
+from results import HEADER
+
+
+def answer(chat: str, team: str, place: str) -> List[str]:
+    return ["2026-01-01 12:00:00", chat, "user", "User", "1", "Judge", team, place, "5", "5", "5", "ДА", "", "ДА"]
+
+
+def write(filename: str, rows: List[List[str]]) -> None:
+    with open(filename, "w", newline='', encoding="utf-8") as file:
+        csv.writer(file).writerows(rows)
+
+
+def read(filename: str) -> List[List[str]]:
+    with open(filename, newline='', encoding="utf-8") as file:
+        return list(csv.reader(file))
+
+
+def test_compact_keeps_latest_or_first(tmp_path) -> None:
+    rows = [HEADER, answer("1", "A", "1"), answer("2", "A", "2"), answer("1", "A", "3"), answer("1", "B", "4")]
+    for latest, expected in ((True, [rows[2], rows[3], rows[4]]), (False, [rows[1], rows[2], rows[4]])):
+        filename = str(tmp_path / f"answers_{latest}.csv")
+        write(filename, rows)
+        assert results.compact_results(filename, latest) == (3, 1)
+        assert read(filename) == [HEADER] + expected
+        with open(filename, "rb") as file:
+            assert b"\r" not in file.read()
+
+
+def test_compact_missing_file(tmp_path) -> None:
+    filename = str(tmp_path / "answers_out.csv")
+    assert results.compact_results(filename) == (0, 0)
+    assert not (tmp_path / "answers_out.csv").exists()
@@ -0,0 +1,32 @@
+import asyncio
+import csv
+
+import bot
+import results
+
+
+def answer(chat: str, comment: str):
+    return ["2026-01-01 12:00:00", chat, "user", "User", "1", "Judge", "Team", "1", "5", "5", "5", "ДА", comment, "ДА"]
+
+
+def test_rows_of_other_workers_are_added_once(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(bot, "answers_shared", True)
+    tenant = bot.Tenant("", str(tmp_path))
+    with open(tenant.output_filename, "w", newline='', encoding="utf-8") as file:
+        csv.writer(file).writerows([results.HEADER, answer("1", "опоздал\nна раунд")])
+
+    async def run() -> None:
+        tenant.start()
+        answers = await tenant.get_answers()
+        assert answers is tenant.answers
+        assert answers.stats.total.count == 1
+        # Another worker appends an answer
+        with open(tenant.output_filename, "a", newline='', encoding="utf-8") as file:
+            csv.writer(file).writerow(answer("2", "опоздал"))
+        assert len((await tenant.get_answers()).comments.search("опоздал")) == 2
+        assert (await tenant.get_answers()).stats.total.count == 2
+
+    try:
+        asyncio.run(run())
+    finally:
+        tenant.close()
@@ -0,0 +1,95 @@
+import asyncio
+import os
+import sqlite3
+import time
+
+import pytest
+from telegram.ext import PicklePersistence
+
+import sqlite_persistence
+from sqlite_persistence import CHAT, USER, SqlitePersistence
+
+
+def test_locked_database_keeps_rows_and_retries(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(sqlite_persistence, "COMMIT_RETRY_SECONDS", 0.1)
+    filename = str(tmp_path / "persistence.sqlite")
+    persistence = SqlitePersistence(filename)
+    other = sqlite3.connect(filename, isolation_level=None)
+
+    async def run() -> None:
+        other.execute("BEGIN IMMEDIATE")
+        await persistence.update_user_data(7, {"form": 1})
+        started = time.perf_counter()
+        await asyncio.sleep(0)
+        # The loop was not held for sqlite's default busy wait and the row is still pending
+        assert time.perf_counter() - started < 1
+        assert (USER, 7) in persistence._dirty
+        other.execute("COMMIT")
+        await asyncio.sleep(0.3)
+        assert not persistence._dirty
+        await persistence.flush()
+
+    asyncio.run(run())
+    assert SqlitePersistence(filename)._read(USER, 7) == {"form": 1}
+
+
+def test_commit_without_loop_raises_and_keeps_rows(tmp_path) -> None:
+    filename = str(tmp_path / "persistence.sqlite")
+    persistence = SqlitePersistence(filename)
+    other = sqlite3.connect(filename, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    with pytest.raises(sqlite3.OperationalError):
+        persistence._mark_dirty(USER, 7, {"form": 1})
+    assert (USER, 7) in persistence._dirty
+    other.execute("COMMIT")
+    persistence.commit()
+    assert persistence._read(USER, 7) == {"form": 1}
+
+
+def test_migrate_pickle_in_one_transaction(tmp_path, monkeypatch) -> None:
+    pickle_filename = str(tmp_path / "old.pickle")
+    filename = str(tmp_path / "persistence.sqlite")
+
+    async def write_pickle() -> None:
+        old = PicklePersistence(pickle_filename)
+        for user_id in range(100):
+            await old.update_user_data(user_id, {"form": {"stage": user_id}})
+        await old.update_chat_data(5, {"chat": True})
+        await old.update_bot_data({"bot": 1})
+        await old.update_conversation("form", (5, 7), 3)
+        await old.flush()
+
+    asyncio.run(write_pickle())
+    writes = []
+    write = SqlitePersistence._write
+    monkeypatch.setattr(SqlitePersistence, "_write", lambda self: writes.append(1) or write(self))
+    sqlite_persistence.migrate_pickle(pickle_filename, filename)
+    assert len(writes) == 1
+    assert not os.path.exists(filename + ".tmp")
+
+    persistence = SqlitePersistence(filename)
+    assert persistence._read(USER, 99) == {"form": {"stage": 99}}
+    assert persistence._read(CHAT, 5) == {"chat": True}
+    assert asyncio.run(persistence.get_bot_data()) == {"bot": 1}
+    assert asyncio.run(persistence.get_conversations("form")) == {(5, 7): 3}
+
+
+def test_failed_migration_leaves_no_database(tmp_path, monkeypatch) -> None:
+    pickle_filename = str(tmp_path / "old.pickle")
+    filename = str(tmp_path / "persistence.sqlite")
+
+    async def write_pickle() -> None:
+        old = PicklePersistence(pickle_filename)
+        await old.update_user_data(1, {"form": {}})
+        await old.flush()
+
+    asyncio.run(write_pickle())
+
+    def fail(self) -> None:
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(SqlitePersistence, "_write", fail)
+    with pytest.raises(sqlite3.OperationalError):
+        sqlite_persistence.migrate_pickle(pickle_filename, filename)
+    assert not os.path.exists(filename)
+    assert not os.path.exists(filename + ".tmp")
@@ -0,0 +1,49 @@
+import asyncio
+import time
+
+from telegram import Update
+
+import bot
+from bench_load import message_update
+
+
+def test_busy_chat_does_not_delay_other_chats() -> None:
+    async def run() -> float:
+        processor = bot.PerChatUpdateProcessor(2)
+        finished = {}
+
+        async def handle(name: str) -> None:
+            await asyncio.sleep(0.1)
+            finished[name] = time.perf_counter()
+
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(processor.process_update(Update.de_json(message_update(1, "x"), None),
+                                                              handle(f"busy {i}"))) for i in range(6)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(processor.process_update(Update.de_json(message_update(2, "x"), None),
+                                                                  handle("other"))))
+        await asyncio.gather(*tasks)
+        # The busy chat's updates still ran one after another
+        assert finished["busy 5"] - started >= 0.6
+        return finished["other"] - started
+
+    assert asyncio.run(run()) < 0.3
+
+
+def test_limit_applies_across_chats() -> None:
+    async def run() -> int:
+        processor = bot.PerChatUpdateProcessor(2)
+        running = peak = 0
+
+        async def handle() -> None:
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.05)
+            running -= 1
+
+        await asyncio.gather(*(processor.process_update(Update.de_json(message_update(chat, "x"), None), handle())
+                               for chat in range(1, 7)))
+        return peak
+
+    assert asyncio.run(run()) == 2
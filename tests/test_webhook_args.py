@@ -0,0 +1,18 @@
+import argparse
+
+import bot
+
+
+def args(**values) -> argparse.Namespace:
+    return argparse.Namespace(**{"mode": "webhook", "webhook_url": "", "secret_token": "", **values})
+
+
+def test_webhook_needs_url() -> None:
+    assert "--webhook-url" in bot.check_webhook(args())
+    assert bot.check_webhook(args(webhook_url="https://example.org/telegram", secret_token="s")) is None
+    assert bot.check_webhook(args(mode="polling")) is None
+
+
+def test_webhook_without_secret_warns(caplog) -> None:
+    assert bot.check_webhook(args(webhook_url="https://example.org/telegram")) is None
+    assert "secret token" in caplog.text
@@ -0,0 +1,30 @@
+import os
+import queue
+import shutil
+
+import bot
+import workers
+
+FORM_FILENAME = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "form.json")
+
+
+def test_worker_builds_tenants_from_its_settings(tmp_path, monkeypatch) -> None:
+    # worker_main changes these, put them back after the test
+    for name in ("tournaments", "output_filename", "max_live_forms", "outbound_global_rate", "answers_shared",
+                 "metrics_port", "tenants"):
+        monkeypatch.setattr(bot, name, getattr(bot, name))
+    monkeypatch.setattr(bot, "start_services", lambda: None)
+    monkeypatch.setattr(workers.signal, "signal", lambda *args: None)
+
+    async def serve(updates, ready=None) -> int:
+        return 0
+
+    monkeypatch.setattr(workers, "serve", serve)
+    shutil.copy(FORM_FILENAME, tmp_path / "form.json")
+    done = queue.Queue()
+    workers.worker_main(0, 2, queue.Queue(), done, {"tournaments": {"cup": str(tmp_path)},
+                                                   "output_filename": "cup.csv", "max_live_forms": 5})
+    assert list(bot.tenants) == ["cup"]
+    assert bot.tenants["cup"].output_filename == os.path.join(str(tmp_path), "cup.csv")
+    assert bot.tenants["cup"].form_sessions.max_forms == 5
+    assert done.get_nowait()[:2] == (0, 0)
@@ -0,0 +1,141 @@
+import asyncio
+import multiprocessing
+import signal
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from telegram import Bot, Update
+from telegram.ext import Updater
+
+import bot
+
+# Update handling spread over several processes (bot.worker_processes / --workers).
+# The main process only receives updates (polling or webhook, as in bot.run_mode) and passes every update
+# to worker number chat_id % N, so all updates of a chat are handled in order by the same worker.
+# Every worker runs the usual application from bot.build_application. Forms live in user_data and a chat
+# never changes its worker, so workers never touch the same form. What they do share:
+# - the sqlite persistence, every worker writes only the rows of its own users,
+# - the answers and chat id files of every tournament, every batch is appended under a file lock (bot.locked),
+# - the Telegram flood limits, every worker sends at most outbound_global_rate / N requests per second.
+# /stats and /search first read the answers other workers appended since the last call (bot.SharedAnswers).
+# Workers are started with "spawn", so they only see the settings written in bot.py and in `settings`.
+
+
+def shard(chat_id: int, workers: int) -> int:
+    return chat_id % workers
+
+
+def update_chat_id(update: Update) -> int:
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return 0
+
+
+# Entry point of a worker process. Updates arrive as dicts (Update.to_dict) in `updates`, None stops the worker
+# after everything received before it is handled. When done, (index, updates handled, time.time()) is put
+# into `done`. `ready` is set once the worker accepts updates.
+def worker_main(index: int, workers: int, updates: multiprocessing.Queue, done: multiprocessing.Queue,
+                settings: Optional[Dict[str, Any]] = None, ready=None) -> None:
+    # Ctrl+C goes to the whole process group, the main process tells the workers when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for name, value in (settings or {}).items():
+        setattr(bot, name, value)
+    # The tenants were built from the settings of bot.py when it was imported
+    error = bot.check_tournaments()
+    if error is not None:
+        raise SystemExit(f"Worker {index}: {error}")
+    bot.tenants = bot.build_tenants()
+    bot.outbound_global_rate /= workers
+    if bot.metrics_port:
+        bot.metrics_port += index + 1
+    bot.answers_shared = True
+    bot.worker_shard = (index, workers)
+    errors = bot.reload_forms()
+    if errors:
+        raise SystemExit(f"Worker {index}: can't load the forms: {'; '.join(errors)}")
+    bot.load_chat_registries(compact=False)
+    bot.start_services()
+    handled = asyncio.run(serve(updates, ready))
+    done.put((index, handled, time.time()))
+    for tenant in bot.tenants.values():
+        tenant.close()
+
+
+async def serve(updates: multiprocessing.Queue, ready=None) -> int:
+    application = bot.build_application()
+    loop = asyncio.get_running_loop()
+    finished = asyncio.Event()
+    handled = 0
+
+    # Blocking reads from the process queue happen in a thread, updates are handed to the loop in order
+    def read() -> None:
+        nonlocal handled
+        while True:
+            data = updates.get()
+            if data is None:
+                loop.call_soon_threadsafe(finished.set)
+                return
+            update = Update.de_json(data, application.bot)
+            loop.call_soon_threadsafe(application.update_queue.put_nowait, update)
+            handled += 1
+
+    async with application:
+        # post_init only runs with run_polling / run_webhook
+        bot.restore_form_sessions(application)
+        await application.start()
+        threading.Thread(target=read, name="worker-updates", daemon=True).start()
+        if ready is not None:
+            ready.set()
+        await finished.wait()
+        # Updates handled during stop() could not send their message edits (create_task is refused then),
+        # so everything queued is handled first
+        await application.update_queue.join()
+        await application.stop()
+    return handled
+
+
+# Receives updates in the main process and hands them over to the workers
+async def receive(queues: List[multiprocessing.Queue], mode: str, webhook: Dict[str, Any]) -> None:
+    update_queue: "asyncio.Queue[object]" = asyncio.Queue()
+    updater = Updater(Bot(bot.TOKEN_STR, base_url=bot.bot_api_base_url), update_queue)
+    async with updater:
+        if mode == "webhook":
+            await updater.start_webhook(**webhook)
+        else:
+            await updater.start_polling()
+        try:
+            while True:
+                update = await update_queue.get()
+                if isinstance(update, Update):
+                    queues[shard(update_chat_id(update), len(queues))].put(update.to_dict())
+        finally:
+            await updater.stop()
+
+
+# `settings` are passed on to worker_main
+def run(workers: int, mode: str, webhook: Dict[str, Any], settings: Optional[Dict[str, Any]] = None) -> None:
+    if bot.fcntl is None:
+        raise SystemExit("Several workers need file locks (fcntl), which this system does not have")
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue() for _ in range(workers)]
+    done = context.Queue()
+    processes = [context.Process(target=worker_main, args=(index, workers, queues[index], done, settings),
+                                 name=f"worker-{index}") for index in range(workers)]
+    for process in processes:
+        process.start()
+    print(f"Started {workers} workers")
+    try:
+        asyncio.run(receive(queues, mode, webhook))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for updates in queues:
+            updates.put(None)
+        for process in processes:
+            process.join()
+        for _ in range(sum(1 for process in processes if process.exitcode == 0)):
+            index, handled, _ = done.get()
+            print(f"Worker {index} handled {handled} updates")